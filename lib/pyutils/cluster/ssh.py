@@ -8,6 +8,7 @@ import getpass
 import re
 import subprocess
 import sys
+import time
 from threading import Thread
 
 from pyutils.common.fileutils import fileToList, normalizeName
@@ -30,17 +31,18 @@ class SSHArgsParser(object):
         self.posargs = []
 
     def parse(self, args):
-        args = list(args)
-        while len(args) > 0:
-            arg = args.pop(0)
+        i = 0
+        while i < len(args):
+            arg = args[i]
+            i += 1
             if arg.startswith('-'):
                 key = arg.lstrip('-')
                 if key in self.val_opts:
                     self.options.append(arg)
-                    try:
-                        self.options.append(args.pop(0))
-                    except IndexError:
+                    if i == len(args):
                         raise IndexError('-%s option needs another arg' %key)
+                    self.options.append(args[i])
+                    i += 1
                     continue
                 else:
                     valid = True
@@ -58,6 +60,10 @@ class SSHArgsParser(object):
 
 
 class SSHCmd(CmdObject):
+    #seconds to wait for the pipes to drain once the command exited. A remote
+    #command leaving a background child holding the pipes never closes them
+    DRAIN_TIMEOUT = 0.1
+
     def __init__(self, command, outBufSize, errBufSize):
         CmdObject.__init__(self, command)
         self.outBuf = []
@@ -67,6 +73,7 @@ class SSHCmd(CmdObject):
         self.numOutLines = 0
         self.outHandler = None
         self.errHandler = None
+        self.readers = []
 
     def enqueueOutput(self, handler, buf, size):
         for line in iter(handler.readline, b''):
@@ -88,14 +95,20 @@ class SSHCmd(CmdObject):
                             args=(self.outHandler, self.outBuf, self.outBufSize))
             thread.daemon = True
             thread.start()
+            self.readers.append(thread)
         if self.errHandler is None and self.proc.stderr is not None:
             self.errHandler = self.proc.stderr
             thread = Thread(target=self.enqueueOutput,
                             args=(self.errHandler, self.errBuf, self.errBufSize))
             thread.daemon = True
             thread.start()
+            self.readers.append(thread)
 
     def cleanup(self):
+        #let the readers drain the pipes before closing them
+        deadline = time.time() + self.DRAIN_TIMEOUT
+        for thread in self.readers:
+            thread.join(max(deadline - time.time(), 0))
         try:
             self.outHandler.close()
             self.errHandler.close()
@@ -1,39 +1,105 @@
+import contextlib
+import hashlib
+import marshal
+import os
 import re
 import sys
+import tempfile
 import xml.etree.ElementTree as ET
+import xml.parsers.expat as expat
+from xml.sax.saxutils import escape
 
 import pyutils.common.fileutils as fu
 import pyutils.common.importutils as iu
+from pyutils.common.parse import RangeSet
 
 from pyutils.common.clirunnable import CliRunnable
 
 class Configuration:
+    """ Key value configuration with ${key} variable expansion.
+
+    The configuration is a stack of layers, from the lowest priority up:
+    defaults, resources and the overrides set by setv. Resource files are
+    only parsed when a lookup reaches their layer, and the raw value found
+    for each key is cached.
+
+    Each value is compiled once into a template of literals and referred
+    keys. References are expanded transitively and the expanded values are
+    cached. setv only drops the cached values depending on the changed key.
+    References to unknown keys are kept as they are.
+
+    """
     VAR_MATCH = '\$\{[^}$\s]+\}'
+    VAR_SPLIT = re.compile('\$\{([^}$\s]+)\}')
 
     def __init__(self):
-        self._dict = {}
+        #resource layers, lowest priority first, and the setv overrides
+        self._layers = []
+        self._overrides = {}
+        #key -> raw value of the top most layer having it, or None
+        self._merged = {}
+        #key -> compiled template, key -> expanded value, and
+        #key -> set of keys whose values refer to it
+        self._templates = {}
+        self._expanded = {}
+        self._dependents = {}
 
     def addResources(self, resList):
+        """ Add resources above the existing ones.
+
+        A resource is a xml or properties file name, a dict or another
+        Configuration, whose layers are shared. Later resources take
+        priority over earlier ones.
+
+        """
         if not isinstance(resList, list):
             resList = [resList]
         for res in resList:
-            self._addResource(res)
+            self._layers.extend(self._addResource(res))
+        self._invalidateAll()
+
+    def addDefaults(self, resList):
+        """ Add resources below the existing ones. """
+        if not isinstance(resList, list):
+            resList = [resList]
+        layers = []
+        for res in resList:
+            layers.extend(self._addResource(res))
+        self._layers[0:0] = layers
+        self._invalidateAll()
 
     def _addResource(self, res):
+        """ Return the layers of a resource. """
         if isinstance(res, Configuration):
-            self._dict.update(res._dict)
-        elif (isinstance(res, str) and res.endswith('.xml')):
-            parser = XmlConfigParser()
-            self._dict = parser.parse(res)
-        elif (isinstance(res, str) and
-              (res.endswith('.properties') or
-               res.endswith('.prop'))):
-            parser = PropConfigParser()
-            self._dict = parser.parse(res)
+            return res._layers + [ConfigLayer(res._overrides)]
+        return [ConfigLayer(res)]
+
+    def _lookup(self, key):
+        """ Return the raw value of key, or None if no layer has it. """
+        try:
+            return self._merged[key]
+        except KeyError:
+            pass
+        val = self._overrides.get(key)
+        if val == None:
+            for layer in reversed(self._layers):
+                val = layer.get(key)
+                if val != None:
+                    break
+        self._merged[key] = val
+        return val
+
+    def _mergedDict(self):
+        """ Return all keys and raw values, parsing all layers. """
+        ret = {}
+        for layer in self._layers:
+            ret.update(layer.getDict())
+        ret.update(self._overrides)
+        return ret
 
     def getv(self, key, default=None, convertType=str):
-        if self._dict.has_key(key):
-            return convertType(self._subVar(self._dict[key]))
+        if self._lookup(key) != None:
+            return convertType(self._expand(key))
         else:
             return default
 
@@ -41,31 +107,14 @@ class Configuration:
         listStr = self.getv(key, "")
         if listStr == None:
             return default
-        strList = re.split('\s*,\s*', listStr)
-        for i in range(len(strList)):
-            strList[i] = self._subVar(strList[i])
-        return strList
+        return re.split('\s*,\s*', listStr)
 
     def getIntRange(self, key, default=[]):
-        listStr = self.getv(key, "")
+        """ Return a sorted RangeSet of e.g. '1, 3:6, 0:2:10' """
+        listStr = self.getv(key)
         if listStr == None:
             return default
-        strList = re.split('\s*,\s*', listStr)
-        ret = set([])
-        for s in strList:
-            if ':' in s:
-                linspace = re.split('\s*:\s*', s)
-                start = int(linspace[0])
-                end = int(linspace[-1])
-                if len(linspace) == 3:
-                    step = int(linspace[1])
-                else:
-                    step = 1
-                for i in range(start, end, step):
-                    ret.add(i)
-            else:
-                ret.add(int(s))
-        return sorted(ret)
+        return RangeSet.fromString(listStr).normalize()
 
     def getClass(self, key, default=None, path=[]):
         clsName = self.getv(key, None)
@@ -78,73 +127,461 @@ class Configuration:
             print ie
             return default
 
+    def _compile(self, key):
+        """ Return the template of the value of key.
+
+        Literals are at the even positions of the template and the referred
+        keys at the odd ones.
+
+        """
+        template = self._templates.get(key)
+        if template == None:
+            template = self.VAR_SPLIT.split(self._lookup(key))
+            for name in template[1::2]:
+                self._dependents.setdefault(name, set([])).add(key)
+            self._templates[key] = template
+        return template
+
+    def _fill(self, template, visiting):
+        """ Join a template, expanding the referred keys. """
+        parts = list(template)
+        for i in range(1, len(parts), 2):
+            if self._lookup(parts[i]) != None:
+                parts[i] = self._expand(parts[i], visiting)
+            else:
+                parts[i] = '${%s}' %parts[i]
+        return ''.join(parts)
+
+    def _expand(self, key, visiting=None):
+        """ Return the cached expanded value of key.
+
+        Raise ValueError if the references of key form a cycle.
+
+        """
+        val = self._expanded.get(key)
+        if val != None:
+            return val
+        template = self._compile(key)
+        if len(template) == 1:
+            val = template[0]
+        else:
+            if visiting == None:
+                visiting = []
+            if key in visiting:
+                cycle = visiting[visiting.index(key):] + [key]
+                raise ValueError('cyclic variable reference: %s'
+                                 %' -> '.join(cycle))
+            visiting.append(key)
+            val = self._fill(template, visiting)
+            visiting.pop()
+        self._expanded[key] = val
+        return val
+
     def _subVar(self, var):
-        match = re.match(self.VAR_MATCH, var)
-        if match == None:
-            return var
-        key = match.group().strip('${').strip('}')
-        if not self._dict.has_key(key):
-            return var
-        val = self._dict[key]
-        return re.sub(self.VAR_MATCH, val, var)
+        """ Expand the references in a string. """
+        return self._fill(self.VAR_SPLIT.split(var), [])
+
+    def _invalidate(self, key):
+        """ Drop the template of key and the values expanded from it. """
+        template = self._templates.pop(key, None)
+        if template != None:
+            for name in template[1::2]:
+                self._dependents[name].discard(key)
+        seen = set([key])
+        stack = [key]
+        while len(stack) != 0:
+            curr = stack.pop()
+            self._expanded.pop(curr, None)
+            for dependent in self._dependents.get(curr, ()):
+                if not dependent in seen:
+                    seen.add(dependent)
+                    stack.append(dependent)
+
+    def _invalidateAll(self):
+        self._merged = {}
+        self._templates = {}
+        self._expanded = {}
+        self._dependents = {}
 
     def setv(self, key, val):
-        self._dict[key] = str(val)
+        self._overrides[key] = str(val)
+        self._merged[key] = self._overrides[key]
+        self._invalidate(key)
 
     def write(self, filename):
+        """ Write the configuration to filename.
+
+        An existing file is patched: only the values that differ are
+        replaced and new keys are added at its end, so the order, comments
+        and formatting of the other entries are kept. The file is replaced
+        atomically and not touched if nothing changed.
+
+        """
         if filename.endswith('.xml'):
             writer = XmlConfigWriter()
-            writer.write(self._dict, fu.normalizeName(filename))
         else:
             writer = PropConfigWriter()
-            writer.write(self._dict, fu.normalizeName(filename))
+        filename = fu.normalizeName(filename)
+        if os.path.exists(filename):
+            data = writer.patch(self._mergedDict(), filename)
+        else:
+            data = writer.dumps(self._mergedDict())
+        if data != None:
+            fu.writeAtomic(filename, data)
+
+    @contextlib.contextmanager
+    def writing(self, filename):
+        """ Write the configuration once, after the setv calls in a block.
+
+            with conf.writing(filename):
+                conf.setv(key0, val0)
+                conf.setv(key1, val1)
+
+        """
+        yield self
+        self.write(filename)
 
     def iteritems(self):
-        return self._dict.iteritems()
+        return self._mergedDict().iteritems()
 
 
     def __str__(self):
-        return str(self._dict)
+        return str(self._mergedDict())
+
+
+class ConfigLayer:
+    """ A configuration resource, parsed on the first lookup. """
+    def __init__(self, res):
+        self.res = res
+        self._dict = None
+        if isinstance(res, dict):
+            self._dict = dict(res)
+
+    def getDict(self):
+        if self._dict == None:
+            res = self.res
+            if (isinstance(res, str) and res.endswith('.xml')):
+                self._dict = configCache.parse(res, XmlConfigParser())
+            elif (isinstance(res, str) and
+                  (res.endswith('.properties') or
+                   res.endswith('.prop'))):
+                self._dict = configCache.parse(res, PropConfigParser())
+            else:
+                self._dict = {}
+        return self._dict
+
+    def get(self, key):
+        return self.getDict().get(key)
+
+
+class ConfigSchema:
+    """ Typed accessors for a Configuration, compiled once.
+
+    Each key is declared with a kind, a default and whether it is required.
+    A kind is a conversion function such as int or float, BOOL, STRINGS
+    (see Configuration.getStrings) or INT_RANGE (see getIntRange).
+
+        schema = ConfigSchema()
+        schema.add('num.nodes', int, required=True)
+        schema.add('input.dirs', ConfigSchema.STRINGS, [])
+        values = schema.compile(conf)
+        values['num.nodes']
+
+    compile() converts all the keys up front and returns a flat dict, so
+    the lookups in hot loops do no parsing.
+
+    """
+    BOOL = 'bool'
+    STRINGS = 'strings'
+    INT_RANGE = 'intrange'
+    KINDS = (BOOL, STRINGS, INT_RANGE)
+    TRUE_STRINGS = ('true', 'yes', 'on', '1')
+    FALSE_STRINGS = ('false', 'no', 'off', '0')
+
+    def __init__(self):
+        self._entries = []
+
+    def add(self, key, kind=str, default=None, required=False):
+        if not callable(kind) and not kind in self.KINDS:
+            raise ValueError('unknown kind for %s: %s' %(key, kind))
+        self._entries.append((key, kind, default, required))
+        return self
+
+    def _convert(self, conf, key, kind):
+        if kind == self.STRINGS:
+            return conf.getStrings(key)
+        if kind == self.INT_RANGE:
+            return conf.getIntRange(key)
+        if kind == self.BOOL:
+            val = conf.getv(key).strip().lower()
+            if val in self.TRUE_STRINGS:
+                return True
+            if val in self.FALSE_STRINGS:
+                return False
+            raise ValueError('not a boolean: %s' %val)
+        return conf.getv(key, convertType=kind)
+
+    def compile(self, conf):
+        """ Return a dict of key -> typed value for the keys in the schema.
+
+        Missing keys get their default. Raise ValueError listing all the
+        missing required keys and the values failing to convert.
+
+        """
+        ret = {}
+        errors = []
+        for key, kind, default, required in self._entries:
+            try:
+                if conf.getv(key) == None:
+                    if required:
+                        errors.append('missing key: %s' %key)
+                    ret[key] = default
+                else:
+                    ret[key] = self._convert(conf, key, kind)
+            except (ValueError, TypeError) as e:
+                errors.append('bad value for %s: %s' %(key, e))
+        if len(errors) != 0:
+            raise ValueError('invalid configuration:\n  ' +
+                             '\n  '.join(errors))
+        return ret
+
+class ConfigCache:
+    """ On-disk cache of parsed configuration files.
+
+    The parsed dict of each file is marshalled into cacheDir, together with
+    the path, mtime and size of every file read to parse it. The cached
+    dict is only used while none of those files changed, so the cache can
+    be shared by all processes and needs no cleanup. If cacheDir is None,
+    the files are always parsed.
+
+    """
+    VERSION = 2
+
+    def __init__(self, cacheDir=None):
+        self.cacheDir = cacheDir
+
+    def _cacheName(self, filename):
+        return os.path.join(self.cacheDir, hashlib.md5(filename).hexdigest())
+
+    def _stat(self, filename):
+        #Configuration.write replaces files by renaming, so a rewrite within
+        #the mtime resolution still changes the inode
+        st = os.stat(filename)
+        return (filename, st.st_mtime, st.st_size, st.st_ino)
+
+    def _load(self, cacheName, filename):
+        """ Return the cached dict of filename, or None if stale. """
+        try:
+            fd = open(cacheName, 'rb')
+            try:
+                version, stats, theDict = marshal.load(fd)
+            finally:
+                fd.close()
+            if version != self.VERSION or stats[0][0] != filename:
+                return None
+            for stat in stats:
+                if self._stat(stat[0]) != stat:
+                    return None
+            return theDict
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+
+    def _store(self, cacheName, entry):
+        """ Atomically replace the cache file. """
+        if not os.path.isdir(self.cacheDir):
+            try:
+                os.makedirs(self.cacheDir)
+            except OSError:
+                #created by another process
+                pass
+        fd, tmpName = tempfile.mkstemp(dir=self.cacheDir)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                marshal.dump(entry, f)
+            finally:
+                f.close()
+            os.rename(tmpName, cacheName)
+        except:
+            os.remove(tmpName)
+            raise
+
+    def parse(self, filename, parser):
+        """ Return parser.parse(filename), from the cache if fresh. """
+        filename = fu.normalizeName(filename)
+        if self.cacheDir == None:
+            return parser.parse(filename)
+        cacheName = self._cacheName(filename)
+        theDict = self._load(cacheName, filename)
+        if theDict != None:
+            return theDict
+        try:
+            before = self._stat(filename)
+        except OSError:
+            #let the parser report the missing file
+            return parser.parse(filename)
+        theDict = parser.parse(filename)
+        try:
+            stats = [self._stat(name) for name in parser.files]
+            #do not cache a file changed while parsing it
+            if stats[0] == before:
+                self._store(cacheName, (self.VERSION, stats, theDict))
+        except (IOError, OSError):
+            pass
+        return theDict
+
+def _defaultCacheDir():
+    cacheDir = os.environ.get('PYUTILS_CONFIG_CACHE',
+                              '~/.pyutils/cache/config')
+    if cacheDir == '':
+        return None
+    return fu.normalizeName(cacheDir)
+
+#set PYUTILS_CONFIG_CACHE to an empty string to disable the cache
+configCache = ConfigCache(_defaultCacheDir())
 
 
 class XmlConfigParser:
+    """ Streaming parser of xml configuration files.
+
+    The file is fed to expat a block at a time and only the current property
+    is kept, so memory stays proportional to the resulting dict. A nested
+    <configuration> element holds the name of a file to include in place.
+    Including a file into itself raises SyntaxError, a file already
+    included elsewhere is skipped. Errors report the file and line.
+
+    """
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self):
+        #all files read, including the included ones
+        self.files = []
+        #key -> byte offsets of the <value> elements and of the end tag of
+        #<configuration> in the parsed file, not counting included files
+        self.spans = {}
+        self.rootEnd = None
+
     def parse(self, filename):
         retDict = {}
-        tree = ET.parse(fu.normalizeName(filename))
-        root = tree.getroot()
-        if 'configuration' != root.tag:
-            raise ValueError('invalid root tag: ' + root.tag)
-        for prop in root:
-            if 'configuration' == prop.tag:
-                retDict.update(self.parse(prop.text))
-                continue
-            if 'property' != prop.tag:
-                raise ValueError('invalid property tag: ' + prop.tag)
-            key = None
-            val = None
-            for field in prop:
-                if 'name' == field.tag:
-                    #name should not have child
-                    if len(list(field)) != 0:
-                        raise SyntaxError('name should not have child:'
-                                          '%s' %ET.dump(field))
-                    key = field.text
-                if 'value' == field.tag:
-                    #value should not have child
-                    if len(list(field)) != 0:
-                        raise SyntaxError('value should not have child:'
-                                          '%s' %ET.dump(field))
-                    val = field.text
-            if (key == None) or (val == None):
-                raise SyntaxError('no key or value for prop:'
-                                  '%s' %ET.dump(prop))
-            retDict[key] = val
+        self._parse(fu.normalizeName(filename), retDict, [])
         return retDict
 
+    def _parse(self, filename, retDict, including):
+        """ Parse filename into retDict.
+
+        including is the stack of files including this one.
+
+        """
+        self.files.append(filename)
+        including.append(filename)
+        top = len(including) == 1
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        #tags of the open elements, the fields of the current property and
+        #the text of the current name, value or include element
+        tags = []
+        prop = {}
+        text = []
+
+        def error(exc, msg, lineno=None):
+            if lineno == None:
+                lineno = parser.CurrentLineNumber
+            return exc('%s:%s: %s' %(filename, lineno, msg))
+
+        def start(tag, attrs):
+            depth = len(tags)
+            if depth == 0:
+                if 'configuration' != tag:
+                    raise error(ValueError, 'invalid root tag: ' + tag)
+            elif depth == 1:
+                if 'property' == tag:
+                    prop.clear()
+                    prop['lineno'] = parser.CurrentLineNumber
+                elif 'configuration' != tag:
+                    raise error(ValueError, 'invalid property tag: ' + tag)
+                del text[:]
+            elif depth == 2:
+                del text[:]
+                if 'value' == tag and top:
+                    prop['start'] = parser.CurrentByteIndex
+            elif tags[2] in ('name', 'value') and tags[1] == 'property':
+                raise error(SyntaxError,
+                            '%s should not have child' %tags[2])
+            tags.append(tag)
+
+        def end(tag):
+            tags.pop()
+            depth = len(tags)
+            if depth == 0 and top:
+                self.rootEnd = parser.CurrentByteIndex
+            elif depth == 1:
+                if 'configuration' == tag:
+                    self._include(''.join(text).strip(), retDict, including,
+                                  error)
+                    return
+                key = prop.get('name')
+                val = prop.get('value')
+                if (key == None) or (val == None):
+                    raise error(SyntaxError, 'no key or value for prop',
+                                prop['lineno'])
+                retDict[key] = val
+                if top:
+                    self.spans.setdefault(key, []).append(
+                        (prop['start'], prop['end']))
+            elif depth == 2 and tags[1] == 'property':
+                if tag in ('name', 'value'):
+                    prop[tag] = self._text(text)
+                if 'value' == tag and top:
+                    prop['end'] = parser.CurrentByteIndex
+
+        def data(chars):
+            if len(tags) in (2, 3):
+                text.append(chars)
+
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = data
+        f = open(filename, 'rb')
+        try:
+            while True:
+                block = f.read(self.BLOCK_SIZE)
+                parser.Parse(block, len(block) == 0)
+                if len(block) == 0:
+                    break
+        except expat.ExpatError as e:
+            raise SyntaxError('%s:%s: %s' %(
+                filename, e.lineno, expat.ErrorString(e.code)))
+        finally:
+            f.close()
+        including.pop()
+
+    def _include(self, filename, retDict, including, error):
+        filename = fu.normalizeName(filename)
+        if filename in including:
+            raise error(SyntaxError, 'cyclic include of %s' %filename)
+        if filename in self.files:
+            return
+        self._parse(filename, retDict, including)
+
+    def _text(self, text):
+        """ Join text as ElementTree does: None if empty, str if ascii. """
+        if len(text) == 0:
+            return None
+        text = ''.join(text)
+        try:
+            return text.encode('ascii')
+        except UnicodeError:
+            return text
+
 class PropConfigParser:
+    def __init__(self):
+        self.files = []
+
     def parse(self, filename):
         retDict = {}
-        f = open(fu.normalizeName(filename))
+        filename = fu.normalizeName(filename)
+        self.files.append(filename)
+        f = open(filename)
         lineno = 1
         for line in f:
             if line.startswith('#'):
@@ -158,8 +595,19 @@ class PropConfigParser:
         f.close()
         return retDict
 
+def _encode(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
 class XmlConfigWriter:
+    PROPERTY = ('  <property>\n    <name>%s</name>\n    <value>%s</value>\n'
+                '  </property>\n')
+
     def write(self, theDict, filename):
+        fu.writeAtomic(filename, self.dumps(theDict))
+
+    def dumps(self, theDict):
         root = ET.Element('configuration')
         root.text = '\n  \n  '
         lastProp = None
@@ -174,17 +622,97 @@ class XmlConfigWriter:
             value.text = theDict[key]
             value.tail = '\n  '
             lastProp = prop
-        lastProp.tail = '\n\n'
+        if lastProp != None:
+            lastProp.tail = '\n\n'
         root.tail = '\n'
-        tree = ET.ElementTree(root)
-        tree.write(filename)
+        return ET.tostring(root)
+
+    def patch(self, theDict, filename):
+        """ Return the content of filename updated to theDict.
+
+        Only the <value> elements of the changed keys are replaced and the
+        new keys are added before </configuration>. Return None if nothing
+        changed.
+
+        """
+        parser = XmlConfigParser()
+        fileDict = parser.parse(filename)
+        changed = sorted(key for key in theDict
+                         if fileDict.get(key) != theDict[key])
+        if len(changed) == 0:
+            return None
+        f = open(fu.normalizeName(filename), 'rb')
+        data = f.read()
+        f.close()
+        #(start, end, text) replacing data[start:end]
+        edits = []
+        added = []
+        for key in changed:
+            value = _encode(escape(theDict[key]))
+            if not parser.spans.has_key(key):
+                added.append(self.PROPERTY %(_encode(escape(key)), value))
+                continue
+            for start, end in parser.spans[key]:
+                #end is at </value>
+                edits.append((start, data.index('>', end) + 1,
+                              '<value>%s</value>' %value))
+        if len(added) != 0:
+            #insert on the line of </configuration> if it starts it
+            pos = data.rfind('\n', 0, parser.rootEnd) + 1
+            if data[pos:parser.rootEnd].strip() != '':
+                pos = parser.rootEnd
+            edits.append((pos, pos, ''.join(added)))
+        edits.sort()
+        pieces = []
+        last = 0
+        for start, end, text in edits:
+            pieces.append(data[last:start])
+            pieces.append(text)
+            last = end
+        pieces.append(data[last:])
+        return ''.join(pieces)
 
 class PropConfigWriter:
     def write(self, theDict, filename):
-        f = open(fu.normalizeName(filename), 'w')
-        for key, value in theDict.iteritems():
-            f.write('%s = %s\n' %(key, value))
+        fu.writeAtomic(filename, self.dumps(theDict))
+
+    def dumps(self, theDict):
+        return ''.join('%s = %s\n' %(key, value)
+                       for key, value in theDict.iteritems())
+
+    def patch(self, theDict, filename):
+        """ Return the content of filename updated to theDict.
+
+        Only the lines of the changed keys are replaced and the new keys are
+        appended. Return None if nothing changed.
+
+        """
+        fileDict = PropConfigParser().parse(filename)
+        changed = set(key for key in theDict
+                      if fileDict.get(key) != theDict[key])
+        if len(changed) == 0:
+            return None
+        f = open(fu.normalizeName(filename), 'rb')
+        lines = f.readlines()
         f.close()
+        patched = set([])
+        for i in range(len(lines)):
+            line = lines[i]
+            if line.startswith('#'):
+                continue
+            fields = re.split('\s*=\s*', line.strip(), 1)
+            if len(fields) == 2 and fields[0] in changed:
+                key = fields[0]
+                newline = line[len(line.rstrip('\r\n')):] or '\n'
+                lines[i] = '%s = %s%s' %(key, theDict[key], newline)
+                patched.add(key)
+        added = sorted(changed - patched)
+        if len(added) != 0 and len(lines) != 0 and \
+           not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        for key in added:
+            lines.append('%s = %s\n' %(key, theDict[key]))
+        return ''.join(lines)
 
 class ConfigCli(CliRunnable):
     def __init__(self):
@@ -222,15 +750,25 @@ def main(infile, outfile):
     conf.addResources(infile)
     conf.setv('tmp.dir', '/tmp')
     conf.setv('local.dir', '${tmp.dir}/local')
+    conf.setv('data.dir', '${local.dir}/data:${tmp.dir}')
     conf.setv('num.modification', 3)
     print conf
     print conf.getv('local.dir')
+    print conf.getv('data.dir')
+    conf.setv('tmp.dir', '/var/tmp')
+    print conf.getv('data.dir')
     print conf.getv('num.modification', convertType=int)
     conf.setv('str.list', '/data, /data/input , ${tmp.dir}, /data/soclj')
     conf.setv('int.list', '1, 3, 5 , 4:8, 6:2:10')
     conf.write(outfile)
     print conf.getStrings('str.list')
     print conf.getIntRange('int.list')
+    schema = ConfigSchema()
+    schema.add('num.modification', int, required=True)
+    schema.add('str.list', ConfigSchema.STRINGS)
+    schema.add('int.list', ConfigSchema.INT_RANGE)
+    schema.add('debug', ConfigSchema.BOOL, False)
+    print schema.compile(conf)
 
 if __name__ == '__main__':
     main(sys.argv[1], sys.argv[2])
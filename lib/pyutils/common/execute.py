@@ -1,11 +1,15 @@
 import logging
 import shlex
 from subprocess import Popen
+from Queue import Queue, Empty
 import sys
-from time import sleep
-from threading import Thread
+import time
+from threading import Thread, Event
 
 class CmdObject(object):
+    #seconds between two calls of run() while the command executes
+    interval = 1
+
     def __init__(self, command):
         self.command = command
         self.proc = None
@@ -21,6 +25,9 @@ class CmdObject(object):
         pass
 
     def run(self):
+        """ Optional hook, called right after the process starts and then
+        every interval seconds until it exits.
+        """
         pass
 
     def cleanup(self):
@@ -31,9 +38,17 @@ class CmdObject(object):
         return []
 
 class CmdThread(Thread):
-    def __init__(self, cmdobj):
+    """ Run a CmdObject and block on its process until it exits.
+
+    The exit is noticed as soon as the wait returns, instead of on the next
+    poll. If the object overrides run(), a helper thread calls it
+    periodically meanwhile. When done is given, the thread puts itself on
+    it after cleanup so that a scheduler can react immediately.
+    """
+    def __init__(self, cmdobj, done=None):
         Thread.__init__(self)
         self.cmdobj = cmdobj
+        self.done = done
         self.logger = logging.getLogger(self.__class__.__name__)
         self.closed = False
         self.retcode = None
@@ -42,49 +57,92 @@ class CmdThread(Thread):
     def output(self):
         return self.cmdobj.output
 
-    def run(self):
-        self.cmdobj.startup()
-        self.logger.info('start: %s'%self.cmdobj.cmd)
-        proc = Popen(shlex.split(self.cmdobj.command),
-                     stdout=self.cmdobj.stdout, stderr=self.cmdobj.stderr)
-        self.cmdobj.proc = proc
-        while not self.closed:
-            #periodically check the status of execution
-            self.cmdobj.retcode = proc.poll()
-            if self.cmdobj.retcode is not None:
-                break
-            #run the object function
+    def hasHook(self):
+        return type(self.cmdobj).run != CmdObject.run
+
+    def runHook(self, exited):
+        while True:
             self.cmdobj.run()
-            sleep(1)
-        self.cmdobj.cleanup()
-        self.logger.info('end: %s'%self.cmdobj.cmd)
+            if exited.wait(self.cmdobj.interval):
+                break
+
+    def run(self):
+        try:
+            self.cmdobj.startup()
+            self.logger.info('start: %s'%self.cmdobj.cmd)
+            proc = Popen(shlex.split(self.cmdobj.command),
+                         stdout=self.cmdobj.stdout, stderr=self.cmdobj.stderr)
+            self.cmdobj.proc = proc
+            if self.closed:
+                self.terminate()
+            hook = None
+            exited = Event()
+            if self.hasHook():
+                hook = Thread(target=self.runHook, args=(exited,))
+                hook.daemon = True
+                hook.start()
+            try:
+                self.cmdobj.retcode = proc.wait()
+            finally:
+                exited.set()
+                if hook is not None:
+                    hook.join()
+                self.retcode = self.cmdobj.retcode
+                self.cmdobj.cleanup()
+                self.logger.info('end: %s'%self.cmdobj.cmd)
+        finally:
+            if self.done is not None:
+                self.done.put(self)
+
+    def terminate(self):
+        proc = self.cmdobj.proc
+        if proc is None or proc.poll() is not None:
+            return
+        try:
+            proc.terminate()
+        except OSError:
+            #already gone
+            pass
 
     def close(self):
+        """ Stop the command, terminating its process if still running. """
         self.closed = True
+        self.terminate()
 
 def runCommands(commands, numThreads):
+    """ Run commands with at most numThreads of them at a time.
+
+    Every CmdThread reports to a completion queue when it finishes, so the
+    next command is launched as soon as a slot frees up.
+    """
+    pending = iter(commands)
+    done = Queue()
     threads = set([])
     finished = []
     try:
-        while True:
-            #first remove finished threads
-            for thread in list(threads):
-                if not thread.isAlive():
-                    threads.remove(thread)
-                    finished.append(thread)
-            #check terminate condition
-            if len(threads) == 0 and len(commands) == 0:
-                break
-            #try to launch new commands if we can
-            if len(threads) < numThreads and len(commands) != 0:
-                for i in range(len(threads), numThreads):
-                    command = commands.pop(0)
-                    thread = CmdThread(command)
-                    thread.start()
-                    threads.add(thread)
-                    if len(commands) == 0:
+        for command in pending:
+            if len(threads) >= numThreads:
+                #wait for a slot. A timed get keeps Ctrl-C deliverable
+                while True:
+                    try:
+                        thread = done.get(True, 1)
                         break
-            sleep(1)
+                    except Empty:
+                        continue
+                thread.join()
+                threads.remove(thread)
+                finished.append(thread)
+            thread = CmdThread(command, done)
+            thread.start()
+            threads.add(thread)
+        while len(threads) != 0:
+            try:
+                thread = done.get(True, 1)
+            except Empty:
+                continue
+            thread.join()
+            threads.remove(thread)
+            finished.append(thread)
     except (Exception, BaseException) as e:
         print e
         for thread in threads:
@@ -98,3 +156,15 @@ def runCommands(commands, numThreads):
             for item in thread.output:
                 sys.stdout.write(item)
         sys.stdout.flush()
+
+def benchRunCommands(numCommands=200, numThreads=8):
+    commands = [CmdObject('true') for i in range(numCommands)]
+    start = time.time()
+    runCommands(commands, numThreads)
+    elapsed = time.time() - start
+    failed = len([c for c in commands if c.retcode != 0])
+    print ('runCommands: %s commands, %s threads: %.2fs, %s failed'
+           %(numCommands, numThreads, elapsed, failed))
+
+if __name__ == '__main__':
+    benchRunCommands()
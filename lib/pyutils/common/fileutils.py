@@ -5,10 +5,14 @@ common.fileutils.py
 common file operations
 
 """
+import binascii
+import errno
 import os
 import re
 import shutil
+import stat
 import sys
+import tempfile
 
 from pyutils.common.clirunnable import CliRunnable
 from pyutils.common.parse import CustomArgsParser
@@ -29,6 +33,51 @@ def fileToList(fileName, include='.*', exclude='#'):
             ret.append(line.strip())
     return ret
 
+def _createTemp(dirName, baseName):
+    """ Create a new hidden file next to baseName in dirName.
+
+    Unlike tempfile.mkstemp, the file is created with mode 0666 minus the
+    umask, as open() would create it, without touching the process umask.
+    Return the file descriptor and the file name.
+
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    for i in range(tempfile.TMP_MAX):
+        name = os.path.join(dirName, '.%s.%s' %(
+            baseName, binascii.hexlify(os.urandom(6))))
+        try:
+            return os.open(name, flags, 0666), name
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    raise IOError(errno.EEXIST, 'No usable temporary file name found')
+
+def writeAtomic(fileName, data):
+    """ Replace the content of fileName with data atomically.
+
+    data is written to a temporary file in the same directory, which is then
+    renamed over fileName, so readers see either the old or the new content.
+    The permission bits of an existing file are kept.
+
+    """
+    fileName = normalizeName(fileName)
+    dirName, baseName = os.path.split(fileName)
+    fd, tmpName = _createTemp(dirName, baseName)
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        if os.path.exists(fileName):
+            os.chmod(tmpName, stat.S_IMODE(os.stat(fileName).st_mode))
+        os.rename(tmpName, fileName)
+    except:
+        os.remove(tmpName)
+        raise
+
 def listToFile(fileName, ls):
     f = open(normalizeName(fileName), 'w')
     for l in ls:
@@ -3,9 +3,17 @@ parse.py
 
 A object that has a parse() function
 """
+import bisect
+import heapq
+import itertools
 import re
 import sys
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from pyutils.common.clirunnable import CliRunnable
 
 class KeyValParser(object):
@@ -44,6 +52,7 @@ class KeyValParser(object):
         pattern = re.sub('{k:[^}]+?}', '(?P<key>%s)'%keyPattern, pattern)
         pattern = re.sub('{v:[^}]+?}', '(?P<val>%s)'%valPattern, pattern)
         self.pattern = pattern
+        self.regex = re.compile(pattern)
         self.keyType = keyType
         self.valType = valType
 
@@ -57,7 +66,7 @@ class KeyValParser(object):
         return pattern, str
 
     def parse(self, string):
-        match = re.search(self.pattern, string)
+        match = self.regex.search(string)
         if match != None:
             key = self.keyType(match.group('key'))
             val = self.valType(match.group('val'))
@@ -69,6 +78,132 @@ class KeyValParser(object):
         return 'pattern:%s, keyType:%s, valType:%s' %(
             self.pattern, self.keyType, self.valType)
 
+class MultiKeyValParser(object):
+    """
+    MultiKeyValParser:
+        Parses a string with many KeyValParser patterns at once.
+
+        The patterns are also combined into one regex, so a single search
+        tells whether any of them matches. Streams are searched a chunk at
+        a time and only the lines where the combined regex matches are
+        parsed with each pattern.
+    """
+    CHUNK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, patterns):
+        self.parsers = []
+        for pattern in patterns:
+            if not isinstance(pattern, KeyValParser):
+                pattern = KeyValParser(pattern)
+            self.parsers.append(pattern)
+        self.regex = None
+        alternatives = []
+        for parser in self.parsers:
+            #combining shifts the numbered groups of back references
+            if re.search(r'\\[1-9]|\(\?P=', parser.pattern):
+                return
+            alternatives.append('(?:%s)' %self._nonCapturing(parser.pattern))
+        #MULTILINE so that ^ and $ also match at the lines inside a chunk
+        self.regex = re.compile('|'.join(alternatives), re.MULTILINE)
+
+    @staticmethod
+    def _nonCapturing(pattern):
+        """ Turn the capturing groups of pattern into non-capturing ones.
+
+        The combined regex only tells whether a line matches, and Python
+        limits a regex to 100 groups.
+
+        """
+        ret = []
+        i = 0
+        inClass = False
+        while i < len(pattern):
+            c = pattern[i]
+            if c == '\\':
+                ret.append(pattern[i:i + 2])
+                i += 2
+                continue
+            if inClass:
+                if c == ']':
+                    inClass = False
+            elif c == '[':
+                inClass = True
+                #a leading ] or ^] is part of the class
+                j = i + 1
+                if pattern[j:j + 1] == '^':
+                    j += 1
+                if pattern[j:j + 1] == ']':
+                    j += 1
+                c = pattern[i:j]
+                i = j - 1
+            elif c == '(':
+                if pattern[i + 1:i + 4] == '?P<':
+                    c = '(?:'
+                    i = pattern.index('>', i)
+                elif pattern[i + 1:i + 2] != '?':
+                    c = '(?:'
+            ret.append(c)
+            i += 1
+        return ''.join(ret)
+
+    def parse(self, string):
+        """ Return the (key, val) of every pattern matching the string. """
+        if self.regex != None and self.regex.search(string) == None:
+            return []
+        ret = []
+        for parser in self.parsers:
+            match = parser.regex.search(string)
+            if match != None:
+                ret.append((parser.keyType(match.group('key')),
+                            parser.valType(match.group('val'))))
+        return ret
+
+    def parseStream(self, fh, chunkSize=None):
+        """ Yield the (key, val) of every pattern matching each line. """
+        if chunkSize == None:
+            chunkSize = self.CHUNK_SIZE
+        rest = ''
+        while True:
+            chunk = fh.read(chunkSize)
+            if len(chunk) == 0:
+                break
+            chunk = rest + chunk
+            end = chunk.rfind('\n') + 1
+            rest = chunk[end:]
+            for item in self._parseLines(chunk, end):
+                yield item
+        for item in self.parse(rest):
+            yield item
+
+    def parseFile(self, filename, chunkSize=None):
+        f = open(filename, 'rb')
+        try:
+            for item in self.parseStream(f, chunkSize):
+                yield item
+        finally:
+            f.close()
+
+    def _parseLines(self, chunk, end):
+        """ Parse the lines in chunk[0:end], which ends with a newline. """
+        if self.regex == None:
+            for line in chunk[0:end].splitlines(True):
+                for item in self.parse(line):
+                    yield item
+            return
+        pos = 0
+        while pos < end:
+            match = self.regex.search(chunk, pos, end)
+            if match == None or match.start() >= end:
+                return
+            start = chunk.rfind('\n', 0, match.start()) + 1
+            pos = chunk.find('\n', match.start()) + 1
+            line = chunk[start:pos]
+            for parser in self.parsers:
+                match = parser.regex.search(line)
+                if match != None:
+                    yield (parser.keyType(match.group('key')),
+                           parser.valType(match.group('val')))
+
 class CustomArgsParser(object):
     """
     CustomArgsParser:
@@ -77,22 +212,40 @@ class CustomArgsParser(object):
         Args and options are seperated by space. Strings within a pair of
         quotes are of the same arg or option. Only specified customized options
         are recognized and extracted. Other args are kept intact in order.
+
+        parse() walks the args once without modifying them, and each call
+        starts over from the defaults, so a parser can be reused.
     """
-    def __init__(self, optKeys=[], optFlags=[], defaults={}):
-        self.optKeys = optKeys
-        self.optFlags = optFlags
-        self.options = defaults
+    def __init__(self, optKeys=[], optFlags=[], defaults=None):
+        self.optKeys = set(optKeys)
+        self.optFlags = set(optFlags)
+        if defaults == None:
+            defaults = {}
+        self.defaults = dict(defaults)
+        self.options = dict(self.defaults)
         self.posArgs = []
 
     def parse(self, args):
-        while len(args) > 0:
-            arg = args.pop(0)
-            if arg in self.optKeys:
-                self.options[arg] = args.pop(0)
-            elif arg in self.optFlags:
-                self.options[arg] = True
+        options = dict(self.defaults)
+        posArgs = []
+        optKeys = self.optKeys
+        optFlags = self.optFlags
+        i = 0
+        numArgs = len(args)
+        while i < numArgs:
+            arg = args[i]
+            i += 1
+            if arg in optKeys:
+                if i == numArgs:
+                    raise IndexError('%s option needs another arg' %arg)
+                options[arg] = args[i]
+                i += 1
+            elif arg in optFlags:
+                options[arg] = True
             else:
-                self.posArgs.append(arg)
+                posArgs.append(arg)
+        self.options = options
+        self.posArgs = posArgs
 
     def getPosArgs(self):
         return self.posArgs
@@ -111,47 +264,256 @@ class CustomArgsParser(object):
     def getOptions(self):
         return self.options
 
+MSEC_UNITS = (
+    ('year', 1000 * 60 * 60 * 24 * 365),
+    ('mon', 1000 * 60 * 60 * 24 * 30),
+    ('day', 1000 * 60 * 60 * 24),
+    ('hour', 1000 * 60 * 60),
+    ('min', 1000 * 60),
+    ('sec', 1000),
+)
+
+BYTES_UNITS = (
+    ('T', 1024 * 1024 * 1024 * 1024),
+    ('t', 1024 * 1024 * 1024 * 1024),
+    ('G', 1024 * 1024 * 1024),
+    ('g', 1024 * 1024 * 1024),
+    ('M', 1024 * 1024),
+    ('m', 1024 * 1024),
+    ('K', 1024),
+    ('k', 1024),
+)
+
+def _str2unit(string, units):
+    string = string.strip()
+    for suffix, factor in units:
+        if string.endswith(suffix):
+            return float(string[0:-len(suffix)]) * factor
+    return float(string)
+
+def _str2unitArray(strings, units):
+    if numpy == None:
+        raise ImportError('numpy is required for array conversion')
+    size = len(strings)
+    text = '\n'.join(strings) + '\n'
+    if isinstance(text, unicode):
+        try:
+            text = text.encode('ascii')
+        except UnicodeError:
+            text = ''
+    pairs = None
+    #turn each "<num><suffix>" line into "<num> <suffix index>" with a few
+    #string replaces, and let numpy parse all the numbers at once
+    if text.count('\n') == size and text.count(' ') == 0:
+        text = text.replace('\n', ' 0\n')
+        for i in range(len(units)):
+            text = text.replace(units[i][0] + ' 0', ' %d' %(i + 1))
+        if len(text.translate(None, '0123456789.eE+- \n')) == 0:
+            pairs = numpy.fromstring(text, sep=' ')
+    if pairs is None or len(pairs) != 2 * size:
+        #whitespace, other float() syntax or invalid strings
+        return numpy.array([_str2unit(string, units) for string in strings],
+                           dtype=float)
+    factors = numpy.array([1] + [factor for suffix, factor in units],
+                          dtype=float)
+    pairs = pairs.reshape(-1, 2)
+    return pairs[:, 0] * factors[pairs[:, 1].astype(int)]
+
 def str2msec(string):
-    if string.endswith('year'):
-        num = float(string[0:-4])
-        factor = 1000 * 60 * 60 * 24 * 365
-    elif string.endswith('mon'):
-        num = float(string[0:-3])
-        factor = 1000 * 60 * 60 * 24 * 30
-    elif string.endswith('day'):
-        num = float(string[0:-3])
-        factor = 1000 * 60 * 60 * 24
-    elif string.endswith('hour'):
-        num = float(string[0:-4])
-        factor = 1000 * 60 * 60
-    elif string.endswith('min'):
-        num = float(string[0:-3])
-        factor = 1000 * 60
-    elif string.endswith('sec'):
-        num = float(string[0:-3])
-        factor = 1000
-    else:
-        num = float(string)
-        factor = 1
-    return num * factor
+    return _str2unit(string, MSEC_UNITS)
 
 def str2bytes(string):
-    if string.endswith('T') or string.endswith('t'):
-        num = float(string[0:-1])
-        factor = 1024 * 1024 * 1024 * 1024
-    if string.endswith('G') or string.endswith('g'):
-        num = float(string[0:-1])
-        factor = 1024 * 1024 * 1024
-    if string.endswith('M') or string.endswith('m'):
-        num = float(string[0:-1])
-        factor = 1024 * 1024
-    if string.endswith('K') or string.endswith('k'):
-        num = float(string[0:-1])
-        factor = 1024
-    else:
-        num = float(string[0:-1])
-        factor = 1
-    return num * factor
+    return _str2unit(string, BYTES_UNITS)
+
+def str2msecArray(strings):
+    """ Convert a list or array of strings to a numpy array of msecs. """
+    return _str2unitArray(strings, MSEC_UNITS)
+
+def str2bytesArray(strings):
+    """ Convert a list or array of strings to a numpy array of bytes. """
+    return _str2unitArray(strings, BYTES_UNITS)
+
+class RangeSet(object):
+    """
+    RangeSet:
+        A sequence of integers kept as runs of (start, length, step).
+
+        Runs continuing the previous run are merged into it, so ranges of
+        millions of integers take a few tuples. len, membership, indexing,
+        slicing and iteration work on the runs without expanding them.
+    """
+    def __init__(self, runs=[]):
+        """ runs are (start, stop, step) or (start, stop) as for range(). """
+        self._runs = []
+        #index of the first integer of each run
+        self._offsets = []
+        self._len = 0
+        for run in runs:
+            self.addRange(*run)
+
+    @staticmethod
+    def fromString(string):
+        """ Parse 'n, start:stop, start:step:stop, ...' """
+        ret = RangeSet()
+        for n in string.split(','):
+            fields = n.split(':')
+            if len(fields) == 1:
+                ret.add(int(fields[0]))
+            elif len(fields) == 2:
+                ret.addRange(int(fields[0]), int(fields[1]))
+            elif len(fields) == 3:
+                ret.addRange(int(fields[0]), int(fields[2]), int(fields[1]))
+            else:
+                raise ValueError('Bad range: %s' %n)
+        return ret
+
+    def add(self, n):
+        self._append(n, 1, 1)
+
+    def addRange(self, start, stop, step=1):
+        if step == 0:
+            raise ValueError('Range step must not be zero')
+        if step > 0:
+            length = (stop - start + step - 1) // step
+        else:
+            length = (start - stop - step - 1) // -step
+        if length > 0:
+            self._append(start, length, step)
+
+    def _append(self, start, length, step):
+        if len(self._runs) != 0:
+            prevStart, prevLength, prevStep = self._runs[-1]
+            #a single integer continues a run with any step
+            if prevLength == 1 and length == 1:
+                mergeStep = start - prevStart
+            elif prevLength == 1:
+                mergeStep = step
+            elif length == 1 or step == prevStep:
+                mergeStep = prevStep
+            else:
+                mergeStep = 0
+            if mergeStep != 0 and \
+               prevStart + prevLength * mergeStep == start:
+                self._runs[-1] = (prevStart, prevLength + length, mergeStep)
+                self._len += length
+                return
+        self._runs.append((start, length, step))
+        self._offsets.append(self._len)
+        self._len += length
+
+    def runs(self):
+        """ Return the runs as (start, stop, step). """
+        return [(start, start + length * step, step)
+                for start, length, step in self._runs]
+
+    def normalize(self):
+        """ Return the integers sorted and without duplicates. """
+        runs = []
+        for start, length, step in self._runs:
+            if step < 0:
+                start, step = start + (length - 1) * step, -step
+            runs.append((start, length, step))
+        runs.sort()
+        ret = RangeSet()
+        disjoint = True
+        for i in range(1, len(runs)):
+            start, length, step = runs[i - 1]
+            if start + (length - 1) * step >= runs[i][0]:
+                disjoint = False
+                break
+        if disjoint:
+            for run in runs:
+                ret._append(*run)
+            return ret
+        prev = None
+        for n in heapq.merge(*[xrange(start, start + length * step, step)
+                               for start, length, step in runs]):
+            if n != prev:
+                ret.add(n)
+                prev = n
+        return ret
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for start, length, step in self._runs:
+            for n in xrange(start, start + length * step, step):
+                yield n
+
+    def __contains__(self, n):
+        for start, length, step in self._runs:
+            diff = n - start
+            if diff % step == 0 and 0 <= diff // step < length:
+                return True
+        return False
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._slice(*index.indices(self._len))
+        if index < 0:
+            index += self._len
+        if index < 0 or index >= self._len:
+            raise IndexError('RangeSet index out of range')
+        i = bisect.bisect_right(self._offsets, index) - 1
+        start, length, step = self._runs[i]
+        return start + (index - self._offsets[i]) * step
+
+    def _slice(self, start, stop, stride):
+        if stride < 0:
+            reverse = RangeSet()
+            for runStart, length, step in reversed(self._runs):
+                reverse._append(runStart + (length - 1) * step, length, -step)
+            last = self._len - 1
+            return reverse._slice(last - start, last - stop, -stride)
+        ret = RangeSet()
+        if start >= stop:
+            return ret
+        for i in range(bisect.bisect_right(self._offsets, start) - 1,
+                       len(self._runs)):
+            offset = self._offsets[i]
+            if offset >= stop:
+                break
+            runStart, length, step = self._runs[i]
+            #first index in the run on the stride
+            first = max(start, offset)
+            first += (start - first) % stride
+            end = min(stop, offset + length)
+            if first < end:
+                ret._append(runStart + (first - offset) * step,
+                            (end - first + stride - 1) // stride,
+                            step * stride)
+        return ret
+
+    def __eq__(self, other):
+        try:
+            if len(self) != len(other):
+                return False
+        except TypeError:
+            return False
+        for a, b in itertools.izip(self, other):
+            if a != b:
+                return False
+        return True
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        """ The range string, e.g. [1, 3:6, 9]. """
+        runs = []
+        for start, length, step in self._runs:
+            stop = start + length * step
+            if length == 1:
+                runs.append('%s' %start)
+            elif step == 1:
+                runs.append('%s:%s' %(start, stop))
+            else:
+                runs.append('%s:%s:%s' %(start, step, stop))
+        return '[%s]' %', '.join(runs)
+
+    def __repr__(self):
+        return 'RangeSet(%s)' %self.runs()
 
 class RangeStringParser(object):
     REGEX = '\[[0-9,: ]+\]'
@@ -159,23 +521,16 @@ class RangeStringParser(object):
         pass
 
     def parse(self, string):
-        """Example string: [1, 3:6, 9]."""
-        ret = []
+        """Example string: [1, 3:6, 9].
+
+        Return a RangeSet of the integers in the given order.
+
+        """
         if not re.match('^%s$'%RangeStringParser.REGEX, string):
             raise SyntaxError(
                 'Range string must in the form %s: %s'
                 %(string, RangeStringParser.REGEX))
-        string = string.strip('[]')
-        for n in string.split(','):
-            if ':' not in n:
-                ret.append(int(n))
-            else:
-                ranges = n.split(':')
-                if len(ranges) == 2:
-                    ret += range(int(ranges[0]), int(ranges[1]))
-                else:
-                    ret += range(int(ranges[0]), int(ranges[2]), int(ranges[1]))
-        return ret
+        return RangeSet.fromString(string.strip('[]'))
 
 class ParseCli(CliRunnable):
     def __init__(self):
@@ -196,9 +551,33 @@ def testRangeStringParser():
     parser = RangeStringParser()
     print parser.parse('[1,2,3]')
     print parser.parse('[1, 2:4, 5:2:9, 11]')
+    r = parser.parse('[0:1000000000, 7]')
+    print len(r), 999999999 in r, r[-2], r[10:20:3], list(r[-1:-4:-1])
+
+def testMultiKeyValParser():
+    import StringIO
+    parser = MultiKeyValParser(['{k:HDFS_BYTES_%uc}={v:%int}',
+                                '{k:%name} finished in {v:%float}s'])
+    print parser.parse('HDFS_BYTES_READ=100 HDFS_BYTES_WRITTEN=5')
+    log = StringIO.StringIO('noise\nHDFS_BYTES_READ=42\n'
+                            'map_0 finished in 1.5s\nnoise')
+    print list(parser.parseStream(log, 16))
+    #more groups than a single regex may hold
+    parser = MultiKeyValParser(
+        ['{k:counter%s}={v:%%float}' %i for i in range(120)])
+    print parser.parse('counter7=1.5e3'), parser.parse('counter119=2')
+
+def testUnitConversion():
+    print str2bytes('1024'), str2bytes('2T'), str2bytes('1.5k')
+    print str2msec('10'), str2msec('2hour'), str2msec('0.5sec')
+    if numpy != None:
+        print str2bytesArray(['1024', '2T', '1.5k', ' 3 M'])
+        print str2msecArray(['10', '2hour', '0.5sec', 'inf'])
 
 def test():
     testRangeStringParser()
+    testMultiKeyValParser()
+    testUnitConversion()
 
 def main():
     test()
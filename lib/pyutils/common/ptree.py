@@ -4,21 +4,70 @@ ptree.py
 PropertyTree data structure for experiments
 """
 
+import ast
+import bisect
+from collections import OrderedDict
+import contextlib
+import copy
+import cStringIO
+import gc
+import itertools
+import mmap
+import multiprocessing
+import os
 import pickle
 import re
 import sys
+import thread
+import threading
+import time
 import traceback
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from pyutils.common.clirunnable import CliRunnable
+import pyutils.common.fileutils as fu
+from pyutils.common.parse import MultiKeyValParser
+
+def internKey(key):
+    """ Intern an inner key so that equal keys share one string. """
+    if type(key) is str:
+        return intern(key)
+    return key
+
 
 class TreeNode(object):
-    """ Property tree node. """
-    def __init__(self, key, val, children=None):
-        self._key = key
+    """ Property tree node.
+
+    Nodes are slotted, keys are interned and children are only allocated
+    when the first child is added, so leaves stay small. A few children are
+    kept in a plain list. Once there are more than MAX_LIST_CHILDREN they
+    move to an ordered key->child index, so lookup, insert and remove stay
+    O(1) for wide nodes while iteration still follows insertion order.
+
+    Nodes can be shared by several trees. The owner is the token of the
+    tree allowed to modify the node in place, other trees copy it first.
+
+    children is a tuple copy of the children, so changing it in place fails
+    instead of silently doing nothing. Use addChild and removeChild, or
+    assign a new sequence to children.
+
+    """
+    __slots__ = ('_key', '_val', '_children', '_owner')
+
+    MAX_LIST_CHILDREN = 8
+
+    def __init__(self, key, val, children=None, owner=None):
+        self._key = internKey(key)
         self._val = val
-        self._children = children
-        if self._children == None:
-            self._children = []
+        self._children = None
+        self._owner = owner
+        if children != None:
+            for child in children:
+                self.addChild(child)
 
     @property
     def key(self):
@@ -34,24 +83,495 @@ class TreeNode(object):
 
     @property
     def children(self):
-        return self._children
+        children = self._children
+        if children is None:
+            return ()
+        if type(children) is list:
+            return tuple(children)
+        return tuple(children.itervalues())
 
     @children.setter
     def children(self, other):
-        self._children = other
+        self._children = None
+        for child in other:
+            self.addChild(child)
+
+    def iterChildren(self):
+        children = self._children
+        if children is None:
+            return iter(())
+        if type(children) is list:
+            return iter(children)
+        return children.itervalues()
+
+    def numChildren(self):
+        if self._children is None:
+            return 0
+        return len(self._children)
+
+    def getChild(self, key, default=None):
+        children = self._children
+        if children is None:
+            return default
+        if type(children) is list:
+            for child in children:
+                if child._key == key:
+                    return child
+            return default
+        return children.get(key, default)
+
+    def addChild(self, child):
+        """ Add a child, replacing any existing child with the same key. """
+        children = self._children
+        if children is None:
+            self._children = [child]
+        elif type(children) is list:
+            for i in range(len(children)):
+                if children[i]._key == child._key:
+                    children[i] = child
+                    return child
+            children.append(child)
+            if len(children) > self.MAX_LIST_CHILDREN:
+                self._children = OrderedDict(
+                    (c._key, c) for c in children)
+        else:
+            children[child._key] = child
+        return child
+
+    def removeChild(self, key):
+        """ Remove the child with the key.
+
+        Return the removed child or None if not existed.
+
+        """
+        children = self._children
+        if children is None:
+            return None
+        if type(children) is list:
+            child = None
+            for i in range(len(children)):
+                if children[i]._key == key:
+                    child = children.pop(i)
+                    break
+        else:
+            child = children.pop(key, None)
+        if len(children) == 0:
+            self._children = None
+        return child
 
     def hasChild(self):
-        return len(self._children) != 0
+        return self._children is not None
+
+    def copy(self, owner=None):
+        """ Return a copy of the node sharing the children nodes. """
+        node = TreeNode(self._key, self._val, owner=owner)
+        children = self._children
+        if type(children) is list:
+            node._children = list(children)
+        elif children is not None:
+            node._children = OrderedDict(children)
+        return node
+
+    def __getstate__(self):
+        return (self._key, self._val, self.children)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            #dumps from older versions pickle the instance dict
+            key, val, children = (
+                state['_key'], state['_val'], state['_children'])
+            if isinstance(children, dict):
+                children = children.values()
+        else:
+            key, val, children = state
+        self._key = internKey(key)
+        self._val = val
+        self._owner = None
+        self.children = children
 
     def __str__(self):
         ret = []
         ret.append(self._key + "->[")
-        for child in self._children:
+        for child in self.iterChildren():
             ret.append(child.key + ", ")
         ret.append("]")
         return ''.join(ret)
 
 
+class LRUCache(object):
+    """ A small least-recently-used cache, safe to share between threads. """
+    def __init__(self, capacity=128):
+        self.capacity = capacity
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                val = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = val
+            return val
+
+    def put(self, key, val):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = val
+            if len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class TreePattern(object):
+    """ A compiled PropertyTree wildcard pattern.
+
+    The pattern is normalized, validated and split into steps once. Matching
+    walks the tree in a single pass and computes the group keys on the way.
+
+    Steps are tuples of (kind, arg, group):
+        LITERAL --  arg is the tuple of inner keys to dive through
+        ANY     --  * or [, match one inner key
+        DEEP    --  ** or [[, match any number of inner keys until arg, or
+                    all the leaves if arg is None
+
+    """
+    LITERAL = 0
+    ANY = 1
+    DEEP = 2
+
+    def __init__(self, pattern, sep='.', innerkeyRe='[a-zA-Z0-9-_]+'):
+        esep = re.escape(sep)
+        #normalize: remove repeated sep and repeated **
+        pattern = re.sub('(%s)+'%esep, sep, pattern)
+        pattern = re.sub('(\*\*%s)+'%esep, '**' + sep, pattern)
+        pattern = pattern.strip(sep)
+        self.pattern = pattern
+        self.sep = sep
+        self.grouped = '[' in pattern
+        self.steps = []
+        validRe = re.compile('^(\*{1,2}|\[{1,2}|%s)$' %innerkeyRe)
+        levelKeys = pattern.split(sep)
+        literal = []
+        i = 0
+        while i < len(levelKeys):
+            levelKey = levelKeys[i]
+            if not validRe.match(levelKey):
+                raise KeyError("Bad pattern: " + pattern +
+                               " at innterkey:" + levelKey)
+            if levelKey == '*' or levelKey == '[':
+                self._flush(literal)
+                self.steps.append((self.ANY, None, levelKey == '['))
+            elif levelKey == '**' or levelKey == '[[':
+                self._flush(literal)
+                nextKey = None
+                if i < len(levelKeys) - 1:
+                    nextKey = levelKeys[i + 1]
+                    if not validRe.match(nextKey) or nextKey[0] in '*[':
+                        raise KeyError("Bad pattern: " + pattern +
+                                       " wild cards cannot follow ** or [[")
+                    i += 1
+                self.steps.append((self.DEEP, nextKey, levelKey == '[['))
+            else:
+                literal.append(levelKey)
+            i += 1
+        self._flush(literal)
+
+    def _flush(self, literal):
+        if len(literal) != 0:
+            self.steps.append((self.LITERAL, tuple(literal), False))
+            del literal[:]
+
+    @property
+    def keyRe(self):
+        """ The pattern as a regex on full keys, built on first use. """
+        if getattr(self, '_keyRe', None) == None:
+            self._keyRe = self._buildKeyRe()
+        return self._keyRe
+
+    def _buildKeyRe(self):
+        esep = re.escape(self.sep)
+        level = '[^%s]+' %esep
+        levels = '%s(?:%s%s)*' %(level, esep, level)
+        parts = []
+        tail = ''
+        for kind, arg, group in self.steps:
+            if kind == self.LITERAL:
+                parts.append(esep.join(re.escape(k) for k in arg))
+                continue
+            if kind == self.ANY:
+                wild = level
+            else:
+                wild = levels
+            if group:
+                wild = '(%s)' %wild
+            if kind == self.ANY:
+                parts.append(wild)
+            elif arg != None:
+                parts.append('(?:%s%s)?%s' %(wild, esep, re.escape(arg)))
+            elif len(parts) == 0:
+                parts.append(wild)
+            else:
+                tail = '(?:%s%s)?' %(esep, wild)
+        return re.compile('^%s%s$' %(esep.join(parts), tail))
+
+    @property
+    def numGroups(self):
+        return len([step for step in self.steps if step[2]])
+
+    def matchKey(self, fullKey):
+        """ Match the pattern against a full key without a tree.
+
+        Return the group key as match() does, or None if not matched.
+
+        """
+        match = self.keyRe.match(fullKey)
+        if match == None:
+            return None
+        if not self.grouped:
+            return fullKey
+        return tuple(g or '' for g in match.groups())
+
+    def match(self, root, index=None):
+        """ Match the pattern against the tree under root.
+
+        If index is given, it should be the inner key index of the tree
+        rooted at root and is used to look up the key following ** or [[.
+
+        Return a dict of group key -> [(full key, node), ...]. The group key
+        is the full key if the pattern has no group, otherwise a tuple of the
+        inner keys matched by [ and the keys matched by [[.
+
+        Each node matches at most once. With two or more ** or [[, a node can
+        be reached by splitting its key in several ways, e.g. b.0.0 for
+        b.**.0.**. It is then returned once, grouped as matchKey() groups
+        it. The root is not a node of the tree and never matches.
+
+        """
+        sep = self.sep
+        steps = self.steps
+        numSteps = len(steps)
+        ret = {}
+        ambiguous = len([s for s in steps if s[0] == self.DEEP]) >= 2
+        seen = set()
+
+        def emit(node, path, groups):
+            if len(path) == 0:
+                return
+            fullKey = sep.join(path)
+            if ambiguous:
+                if fullKey in seen:
+                    return
+                seen.add(fullKey)
+                if self.grouped:
+                    groups = self.matchKey(fullKey)
+            groupKey = groups if self.grouped else fullKey
+            if not ret.has_key(groupKey):
+                ret[groupKey] = []
+            ret[groupKey].append((fullKey, node))
+
+        stack = [(root, (), 0, ())]
+        while len(stack) != 0:
+            curr, path, step, groups = stack.pop()
+            if step == numSteps:
+                emit(curr, path, groups)
+                continue
+            kind, arg, group = steps[step]
+            if kind == self.LITERAL:
+                for levelKey in arg:
+                    curr = curr.getChild(levelKey)
+                    if curr == None:
+                        break
+                if curr != None:
+                    stack.append((curr, path + arg, step + 1, groups))
+            elif kind == self.ANY:
+                nexts = []
+                for child in curr.iterChildren():
+                    childGroups = groups
+                    if group:
+                        childGroups = groups + (child.key,)
+                    nexts.append(
+                        (child, path + (child.key,), step + 1, childGroups))
+                nexts.reverse()
+                stack.extend(nexts)
+            elif arg == None:
+                #** at the end, every leaf below matches
+                for leaf, rel in self._iterLeaves(curr):
+                    leafGroups = groups
+                    if group:
+                        leafGroups = groups + (sep.join(rel),)
+                    emit(leaf, path + rel, leafGroups)
+            else:
+                nexts = []
+                if index != None:
+                    descendants = self._treeOrder(
+                        curr, self._lookupDescendants(index, path, arg))
+                else:
+                    descendants = self._iterDescendants(curr, arg)
+                for node, rel in descendants:
+                    nodeGroups = groups
+                    if group:
+                        nodeGroups = groups + (sep.join(rel[:-1]),)
+                    nexts.append((node, path + rel, step + 1, nodeGroups))
+                nexts.reverse()
+                stack.extend(nexts)
+        return ret
+
+    def _iterLeaves(self, node):
+        """ Yield (leaf, relative path) for all leaves under node. """
+        stack = [(node, ())]
+        while len(stack) != 0:
+            curr, rel = stack.pop()
+            if not curr.hasChild():
+                yield curr, rel
+                continue
+            for child in reversed(curr.children):
+                stack.append((child, rel + (child.key,)))
+
+    def _iterDescendants(self, node, key):
+        """ Yield (descendant, relative path) for descendants with key. """
+        stack = [(node, ())]
+        while len(stack) != 0:
+            curr, rel = stack.pop()
+            if len(rel) != 0 and curr.key == key:
+                yield curr, rel
+            for child in reversed(curr.children):
+                stack.append((child, rel + (child.key,)))
+
+    def _lookupDescendants(self, index, path, key):
+        """ Yield (descendant, relative path) for indexed nodes under path. """
+        depth = len(path)
+        for nodePath, node in index.get(key, {}).iteritems():
+            if len(nodePath) > depth and nodePath[:depth] == path:
+                yield node, nodePath[depth:]
+
+    def _treeOrder(self, node, descendants):
+        """ Sort (descendant, relative path) under node into tree order.
+
+        Only the children of the nodes on the paths are ranked, so this is
+        much cheaper than walking the subtree.
+
+        """
+        descendants = list(descendants)
+        if len(descendants) <= 1:
+            return descendants
+        ranks = {}
+
+        def rankPath(rel):
+            ret = []
+            curr = node
+            for i in range(len(rel)):
+                rank = ranks.get(rel[:i])
+                if rank == None:
+                    rank = dict((child.key, pos) for pos, child
+                                in enumerate(curr.iterChildren()))
+                    ranks[rel[:i]] = rank
+                ret.append(rank[rel[i]])
+                curr = curr.getChild(rel[i])
+            return ret
+
+        descendants.sort(key=lambda (desc, rel): rankPath(rel))
+        return descendants
+
+    def __str__(self):
+        return self.pattern
+
+
+class Aggregate(object):
+    """ Count, sum, min and max of the numeric values in a subtree.
+
+    Removing the min or max value marks the aggregate stale. Its min and max
+    then have to be recomputed from the subtree.
+
+    """
+    __slots__ = ('count', 'total', 'min', 'max', 'stale')
+
+    FUNCTIONS = ('count', 'sum', 'min', 'max', 'mean')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.stale = False
+
+    def add(self, val):
+        self.count += 1
+        self.total += val
+        if self.min == None or val < self.min:
+            self.min = val
+        if self.max == None or val > self.max:
+            self.max = val
+
+    def discard(self, val):
+        self.count -= 1
+        self.total -= val
+        if self.count == 0:
+            self.total = 0
+            self.min = self.max = None
+            self.stale = False
+        elif val == self.min or val == self.max:
+            self.stale = True
+
+    def __getstate__(self):
+        return (self.count, self.total, self.min, self.max, self.stale)
+
+    def __setstate__(self, state):
+        self.count, self.total, self.min, self.max, self.stale = state
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        self.count += other.count
+        self.total += other.total
+        if self.min == None or other.min < self.min:
+            self.min = other.min
+        if self.max == None or other.max > self.max:
+            self.max = other.max
+        self.stale = self.stale or other.stale
+
+    def unmerge(self, other):
+        if other.count == 0:
+            return
+        if other.count == self.count:
+            self.__init__()
+            return
+        self.count -= other.count
+        self.total -= other.total
+        if other.min <= self.min or other.max >= self.max:
+            self.stale = True
+
+    def get(self, fn):
+        """ Return count, sum, min, max or mean, or fn(self) if callable. """
+        if callable(fn):
+            return fn(self)
+        if fn == 'count':
+            return self.count
+        if fn == 'sum':
+            return self.total
+        if fn == 'min':
+            return self.min
+        if fn == 'max':
+            return self.max
+        if fn == 'mean':
+            if self.count == 0:
+                return None
+            return self.total / float(self.count)
+        raise ValueError('Unknown aggregate function: %s' %fn)
+
+def isNumeric(val):
+    valType = type(val)
+    return valType is int or valType is long or valType is float
+
+
+_patternCache = LRUCache(128)
+
 class PropertyTree(object):
     """
     
@@ -64,12 +584,271 @@ class PropertyTree(object):
     nodes by means of a path, which is a concatenation of multiple keys."(copy
     from boost)
 
+    If indexed, the tree also keeps an inverted index of inner key -> {path:
+    node}, so that ** and [[ followed by an inner key only visit the nodes
+    with that key instead of walking the whole subtree.
+
+    If aggregated, the tree also keeps an Aggregate of the numeric values
+    under every path, updated on each change in O(depth), so aggregate()
+    does not walk the subtrees.
+
+    Nodes are copy-on-write. snapshot() and include() share nodes between
+    trees, and a tree only modifies the nodes it owns, copying the path to
+    any other node it changes. Modify the tree through its methods, not by
+    setting TreeNode.val directly.
+
     """
-    def __init__(self, sep="."):
-        self.root = TreeNode("", None)
+    BATCH_SIZE = 1024
+    LOG_CHUNK_SIZE = 64 * 1024 * 1024
+    CONFLICT_POLICIES = ('first', 'last', 'error')
+
+    _frozen = False
+
+    def __init__(self, sep=".", indexed=False, aggregated=False):
+        self._token = object()
+        self.root = TreeNode("", None, owner=self._token)
         self.sep = sep
         self.innerkeyRe = '[a-zA-Z0-9-_]+'
         self.validRe = re.compile('^(\%s?%s)+$'%(self.sep, self.innerkeyRe))
+        self._index = None
+        self._aggregates = None
+        if indexed:
+            self.buildIndex()
+        if aggregated:
+            self.buildAggregates()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_token']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        #dumps from older versions have no index
+        if not state.has_key('_index'):
+            self._index = None
+        if not state.has_key('_aggregates'):
+            self._aggregates = None
+        #loaded nodes have no owner and are copied on the first change
+        self._token = object()
+
+    def snapshot(self):
+        """ Return a read-only snapshot of the tree in O(1).
+
+        The snapshot shares all nodes with the tree. Later changes to the
+        tree copy the nodes on the changed paths, so the snapshot never
+        sees them. The snapshot is neither indexed nor aggregated.
+
+        """
+        snap = copy.copy(self)
+        snap._index = None
+        snap._aggregates = None
+        snap._frozen = True
+        self._releaseNodes()
+        return snap
+
+    def _releaseNodes(self):
+        """ Give up ownership of all nodes, they are now shared. """
+        self._token = object()
+
+    def _checkWritable(self):
+        if self._frozen:
+            raise TypeError('PropertyTree snapshot is read-only')
+
+    def _writableRoot(self):
+        self._checkWritable()
+        if self.root._owner is not self._token:
+            self.root = self.root.copy(self._token)
+        return self.root
+
+    def _copyChild(self, parent, child, levelKeys):
+        """ Replace a shared child of an owned parent with an owned copy. """
+        child = parent.addChild(child.copy(self._token))
+        if self._index != None:
+            self._index[child.key][tuple(levelKeys)] = child
+        return child
+
+    def _materialize(self, node):
+        """ Copy a foreign node, e.g. a MappedTreeNode, into TreeNodes. """
+        ret = TreeNode(node.key, node.val, owner=self._token)
+        stack = [(node, ret)]
+        while len(stack) != 0:
+            src, dst = stack.pop()
+            for child in src.iterChildren():
+                stack.append((child, dst.addChild(
+                    TreeNode(child.key, child.val, owner=self._token))))
+        return ret
+
+    @property
+    def indexed(self):
+        return self._index != None
+
+    def buildIndex(self):
+        """ Build the inner key index and keep it updated from now on. """
+        self._index = {}
+        self._indexSubtree(self.root, ())
+
+    def dropIndex(self):
+        self._index = None
+
+    def _indexSubtree(self, node, path):
+        stack = [(node, path)]
+        while len(stack) != 0:
+            curr, currPath = stack.pop()
+            if len(currPath) != 0:
+                entries = self._index.get(curr.key)
+                if entries == None:
+                    entries = self._index[curr.key] = {}
+                entries[currPath] = curr
+            for child in curr.iterChildren():
+                stack.append((child, currPath + (child.key,)))
+
+    def _unindexSubtree(self, node, path):
+        stack = [(node, path)]
+        while len(stack) != 0:
+            curr, currPath = stack.pop()
+            entries = self._index.get(curr.key)
+            if entries != None:
+                entries.pop(currPath, None)
+                if len(entries) == 0:
+                    del self._index[curr.key]
+            for child in curr.iterChildren():
+                stack.append((child, currPath + (child.key,)))
+
+    @property
+    def aggregated(self):
+        return self._aggregates != None
+
+    def buildAggregates(self):
+        """ Build the subtree aggregates and keep them updated from now on.
+        """
+        self._aggregates = {}
+        self._aggregateSubtree(self.root, ())
+
+    def dropAggregates(self):
+        self._aggregates = None
+
+    def _aggregateSubtree(self, node, path):
+        """ Store the aggregates of every path in the subtree at path.
+
+        Return the aggregate of the subtree or None if it has no numeric
+        values.
+
+        """
+        ret = None
+        stack = [(node, path, False)]
+        while len(stack) != 0:
+            curr, currPath, visited = stack.pop()
+            if not visited:
+                stack.append((curr, currPath, True))
+                for child in curr.iterChildren():
+                    stack.append((child, currPath + (child.key,), False))
+                continue
+            agg = Aggregate()
+            if isNumeric(curr.val):
+                agg.add(curr.val)
+            for child in curr.iterChildren():
+                childAgg = self._aggregates.get(currPath + (child.key,))
+                if childAgg != None:
+                    agg.merge(childAgg)
+            if agg.count != 0:
+                self._aggregates[currPath] = agg
+                ret = agg
+            else:
+                ret = None
+        return ret
+
+    def _updateAggregates(self, path, old, new):
+        """ Replace value old by new at path in the aggregates. """
+        if not isNumeric(old) and not isNumeric(new):
+            return
+        for depth in range(len(path) + 1):
+            agg = self._aggregates.get(path[:depth])
+            if agg == None:
+                agg = self._aggregates[path[:depth]] = Aggregate()
+            if isNumeric(old):
+                agg.discard(old)
+            if isNumeric(new):
+                agg.add(new)
+
+    def _mergeAggregates(self, path, agg, remove=False):
+        """ Merge (or unmerge) the aggregate of a subtree at path into the
+        aggregates of its ancestors.
+        """
+        for depth in range(len(path)):
+            ancestor = self._aggregates.get(path[:depth])
+            if ancestor == None:
+                ancestor = self._aggregates[path[:depth]] = Aggregate()
+            if remove:
+                ancestor.unmerge(agg)
+            else:
+                ancestor.merge(agg)
+
+    def _unaggregateSubtree(self, node, path):
+        agg = self._aggregates.get(path)
+        if agg == None:
+            return
+        self._mergeAggregates(path, agg, remove=True)
+        stack = [(node, path)]
+        while len(stack) != 0:
+            curr, currPath = stack.pop()
+            self._aggregates.pop(currPath, None)
+            for child in curr.iterChildren():
+                stack.append((child, currPath + (child.key,)))
+
+    def _subtreeAggregate(self, node, path):
+        """ Return the up to date aggregate of the subtree at path. """
+        agg = None
+        if self._aggregates != None:
+            agg = self._aggregates.get(path)
+            if agg == None:
+                return Aggregate()
+            if not agg.stale:
+                return agg
+        #walk the subtree
+        fresh = Aggregate()
+        stack = [node]
+        while len(stack) != 0:
+            curr = stack.pop()
+            if isNumeric(curr.val):
+                fresh.add(curr.val)
+            stack.extend(curr.iterChildren())
+        if agg != None:
+            agg.min = fresh.min
+            agg.max = fresh.max
+            agg.stale = False
+        return fresh
+
+    def aggregate(self, key, fn='sum'):
+        """ Aggregate the numeric values under a key or pattern.
+
+        fn is one of count, sum, min, max, mean, or a function taking an
+        Aggregate. For a key, return the aggregate of its subtree, or None if
+        the key does not exist. For a pattern, return a dict of group key ->
+        aggregate over the subtrees of the matched nodes.
+
+        If the tree is aggregated, each subtree costs O(1) unless a min or
+        max was removed since the last query. Otherwise it is walked.
+
+        """
+        if not callable(fn) and not fn in Aggregate.FUNCTIONS:
+            raise ValueError('Unknown aggregate function: %s' %fn)
+        if not isinstance(key, TreePattern) and \
+           not ('*' in key or '[' in key):
+            try:
+                node = self.find(key)
+            except KeyError:
+                return None
+            path = tuple(self.normalizeKey(key).split(self.sep))
+            return self._subtreeAggregate(node, path).get(fn)
+        ret = {}
+        for groupkey, nodes in self.match(key).iteritems():
+            agg = Aggregate()
+            for fullKey, node in nodes:
+                path = tuple(fullKey.split(self.sep))
+                agg.merge(self._subtreeAggregate(node, path))
+            ret[groupkey] = agg.get(fn)
+        return ret
 
     def normalizeKey(self, key):
         #remove repeated '.'
@@ -103,24 +882,31 @@ class PropertyTree(object):
         return commonKey, rest1, rest2
 
     def _dive(self, key, node, create=False):
+        """ Find the node under node matching the key.
+
+        If create, node must be the owned root. Missing nodes are created
+        and shared nodes on the path are copied, so the returned node can be
+        modified.
+
+        """
         if key == "":
             return node
         levelKeys = key.strip(self.sep).split(self.sep)
         curr = node
         currKey = ""
         for i in range(len(levelKeys)):
-            next = None
             currKey = levelKeys[i]
-            for child in curr.children:
-                if child.key == currKey:
-                    next = child
-                    break
+            next = curr.getChild(currKey)
             if next == None:
                 if not create:
                     raise KeyError("Key not found: %s, %s" %(key, currKey))
                 else:
-                    next = TreeNode(currKey, None)
-                    curr.children.append(next)
+                    next = curr.addChild(
+                        TreeNode(currKey, None, owner=self._token))
+                    if self._index != None:
+                        self._indexSubtree(next, tuple(levelKeys[:i + 1]))
+            elif create and next._owner is not self._token:
+                next = self._copyChild(curr, next, levelKeys[:i + 1])
             curr = next
         return curr
 
@@ -142,20 +928,98 @@ class PropertyTree(object):
         """
         key = self.normalizeKey(key)
         parentKey, childKey = self.splitKey(key)
-        parent = self._dive(parentKey, self.root, create=True)
-        curr = None
-        for child in parent.children:
-            if child.key == childKey:
-                if not overwrite:
-                    raise KeyError("Key already exists: " + key)
-                curr = child
+        parent = self._dive(parentKey, self._writableRoot(), create=True)
+        return self._setChild(parent, key, childKey, val, overwrite)
+
+    def _setChild(self, parent, key, childKey, val, overwrite):
+        """ Set the value of the child of the owned parent node. """
+        curr = parent.getChild(childKey)
         if curr == None:
-            curr = TreeNode(childKey, val)
-            parent.children.append(curr)
+            curr = parent.addChild(TreeNode(childKey, val, owner=self._token))
+            if self._index != None:
+                self._indexSubtree(curr, tuple(key.split(self.sep)))
+            if self._aggregates != None:
+                self._updateAggregates(tuple(key.split(self.sep)), None, val)
         else:
+            if not overwrite:
+                raise KeyError("Key already exists: " + key)
+            if curr._owner is not self._token:
+                curr = self._copyChild(parent, curr, key.split(self.sep))
+            if self._aggregates != None:
+                self._updateAggregates(
+                    tuple(key.split(self.sep)), curr.val, val)
             curr.val = val
         return curr
 
+    def addItems(self, items, presorted=True):
+        """ Add (key, value) pairs in bulk, overwriting existing values.
+
+        The path shared with the previous key is reused instead of diving
+        from the root, and keys are validated a batch at a time. Sorted
+        items share the longest paths. If presorted is False, the items are
+        sorted first.
+
+        Return the tree.
+
+        """
+        sep = self.sep
+        if not presorted:
+            items = sorted(items, key=lambda item: item[0].split(sep))
+        #matches a batch of normalized keys, each followed by a newline
+        batchRe = re.compile('(?:%s(?:%s%s)*\n)*\Z' %(
+            self.innerkeyRe, re.escape(sep), self.innerkeyRe))
+        prevLevels = []
+        prevNodes = [self._writableRoot()]
+        token = self._token
+        items = iter(items)
+        #tree nodes hold no cycles, so skip the collector while allocating
+        gcEnabled = gc.isenabled()
+        gc.disable()
+        try:
+            while True:
+                batch = list(itertools.islice(items, self.BATCH_SIZE))
+                if len(batch) == 0:
+                    break
+                keys = [key for key, val in batch]
+                if not batchRe.match('\n'.join(keys) + '\n'):
+                    keys = [self.normalizeKey(key) for key in keys]
+                for i in range(len(batch)):
+                    levels = keys[i].split(sep)
+                    common = 0
+                    maxCommon = min(len(levels), len(prevLevels))
+                    while common < maxCommon and \
+                          levels[common] == prevLevels[common]:
+                        common += 1
+                    del prevNodes[common + 1:]
+                    curr = prevNodes[common]
+                    for depth in range(common, len(levels)):
+                        next = curr.getChild(levels[depth])
+                        if next == None:
+                            next = curr.addChild(
+                                TreeNode(levels[depth], None, owner=token))
+                            if self._index != None:
+                                self._indexSubtree(
+                                    next, tuple(levels[:depth + 1]))
+                        elif next._owner is not token:
+                            next = self._copyChild(
+                                curr, next, levels[:depth + 1])
+                        prevNodes.append(next)
+                        curr = next
+                    if self._aggregates != None:
+                        self._updateAggregates(
+                            tuple(levels), curr.val, batch[i][1])
+                    curr.val = batch[i][1]
+                    prevLevels = levels
+        finally:
+            if gcEnabled:
+                gc.enable()
+        return self
+
+    @staticmethod
+    def fromItems(items, presorted=True, sep='.'):
+        """ Build a tree from (key, value) pairs. See addItems. """
+        return PropertyTree(sep).addItems(items, presorted)
+
     def remove(self, key):
         """ Remove the TreeNode matching the key. 
 
@@ -168,85 +1032,38 @@ class PropertyTree(object):
             parent = self._dive(parentKey, self.root, create=False)
         except KeyError:
             return False
-        for child in parent.children:
-            if child.key == childKey:
-                parent.children.remove(child)
-                return True
-        return False
+        if parent.getChild(childKey) == None:
+            return False
+        #the path exists, dive again to make it writable
+        parent = self._dive(parentKey, self._writableRoot(), create=True)
+        child = parent.removeChild(childKey)
+        if self._index != None:
+            self._unindexSubtree(child, tuple(key.split(self.sep)))
+        if self._aggregates != None:
+            self._unaggregateSubtree(child, tuple(key.split(self.sep)))
+        return True
 
-    def _dfsKey(self, key, node):
-        queue = []
-        queue.append((node, ""))
-        ret = []
-        while len(queue) != 0:
-            curr, fullKey = queue.pop()
-            if curr.key == key:
-                ret.append((curr, fullKey.strip(self.sep)))
-            for child in curr.children:
-                queue.append((child, fullKey + self.sep + child.key))
-        return ret
+    def compile(self, pattern):
+        """ Compile a wildcard pattern into a TreePattern.
 
-    def _findLeaves(self, node):
-        queue = []
-        queue.append((node, ""))
-        ret = []
-        while len(queue) != 0:
-            curr, fullKey = queue.pop()
-            if not curr.hasChild():
-                ret.append((curr, fullKey.strip(self.sep)))
-            for child in curr.children:
-                queue.append((child, fullKey + self.sep + child.key))
-        return ret
+        Compiled patterns are kept in a LRU cache shared by all trees.
 
-    def _extractGroupKey(self, pattern, fullKey):
-        if not '[' in pattern:
-            return fullKey
-        psplit = pattern.split(self.sep)
-        ksplit = fullKey.split(self.sep)
-        ppos = 0
-        kpos = 0
-        groupKeys = []
-        while ppos < len(psplit):
-            key = psplit[ppos]
-            if key == '[':
-                groupKeys.append(ksplit[kpos])
-            elif key == '*':
-                pass
-            elif key == '**' or key == '[[':
-                ppos += 1
-                extracted = [ksplit[kpos - 1]]
-                if (ppos == len(psplit)):
-                    if key == '[[':
-                        extracted = ksplit[kpos - 1:]
-                        groupkey = self.sep.join(extracted)
-                        groupKeys.append(groupkey)
-                    break
-                nextKey = psplit[ppos]
-                while kpos < len(ksplit):
-                    if ksplit[kpos] == nextKey:
-                        break
-                    else:
-                        if key == '[[':
-                            extracted.append(ksplit[kpos])
-                        kpos += 1
-                if len(extracted) != 0:
-                    groupkey = self.sep.join(extracted)
-                    if key == '[[':
-                        groupKeys.append(groupkey)
-            else:
-                if psplit[ppos] != ksplit[kpos]:
-                    raise KeyError("key not match pattern." +
-                                   " key=" + fullKey +
-                                   " pattern=" + pattern)
-            ppos += 1
-            kpos += 1
-        return tuple(groupKeys)
+        """
+        if isinstance(pattern, TreePattern):
+            return pattern
+        cacheKey = (pattern, self.sep, self.innerkeyRe)
+        compiled = _patternCache.get(cacheKey)
+        if compiled == None:
+            compiled = TreePattern(pattern, self.sep, self.innerkeyRe)
+            _patternCache.put(cacheKey, compiled)
+        return compiled
 
     def match(self, pattern):
         """ Search for all nodes matching the wildcard pattern.
         
         Pattern is a combination of inner keys and special charactors, for
-        example, spam.egg.*.[.**
+        example, spam.egg.*.[.**. It can be a string or a compiled
+        TreePattern.
 
         Special charactor:
             *   --  wild card for matching one inner key
@@ -254,182 +1071,1102 @@ class PropertyTree(object):
             [   --  group using this inner key
             [[  --  group using wild card
 
+        Return a dict of group key -> [(full key, node), ...].
+
         """
-        #normalize: remove repeated sep, add leading sep and remove repeated **
-        pattern = re.sub('(\*\*\.)+','**.', pattern)
-        pattern = re.sub('(\.\.)+', '.', pattern)
-        pattern = pattern.strip(self.sep)
-        #group keys
-        levelKeys = pattern.split(self.sep)
-        keys = []
-        prevstop = 0
-        for i in range(len(levelKeys)):
-            validRe = re.compile('^(\*{1,2}|\[{1,2}|%s)$' %self.innerkeyRe)
-            if not validRe.match(levelKeys[i]):
-                raise KeyError("Bad pattern: " + pattern +
-                               " at innterkey:" + levelKeys[i])
-            if (levelKeys[i] == '**' or levelKeys[i] == '[[') \
-               and i < len(levelKeys) - 1:
-                if levelKeys[i + 1] == '*' or levelKeys[i + 1] == '[':
-                    raise KeyError(
-                        "Bad key: " + key +
-                        "[ and * cannot follow ** or [[")
-            if levelKeys[i] == '*' or levelKeys[i] == '[':
-                prev = self.sep.join(levelKeys[prevstop:i])
-                if prev != "":
-                    keys.append(prev)
-                keys.append(levelKeys[i])
-                prevstop = i + 1
-            if levelKeys[i] == '**' or levelKeys[i] == '[[':
-                prev = self.sep.join(levelKeys[prevstop:i])
-                if prev != "":
-                    keys.append(prev)
-                keys.append(levelKeys[i])
-                if i < len(levelKeys) - 1:
-                    keys.append(levelKeys[i + 1])
-                prevstop = i + 2
-            if i == len(levelKeys) - 1:
-                prev = self.sep.join(levelKeys[prevstop : i + 1])
-                if prev != "":
-                    keys.append(prev)
-        #foreach key, if its a wildcard, then search, otherwise, dive
-        queue = []
-        nodes = {}
-        queue.append((self.root, "", 0))
-        while len(queue) != 0:
-            curr, fullKey, index = queue.pop()
-            fullKey = fullKey.strip(self.sep)
-            if index == len(keys):
-                #if we exhaust the matching pattern, put into nodes
-                groupKey = self._extractGroupKey(pattern, fullKey)
-                if not nodes.has_key(groupKey):
-                    nodes[groupKey] = []
-                nodes[groupKey].append((fullKey, curr))
-                continue
-            nextKey = keys[index]
-            if (nextKey == '*' or nextKey == '['):
-                #a wild card place holder, queue all children
-                for child in curr.children:
-                    queue.append(
-                        (child, fullKey + self.sep + child.key, index + 1))
-            elif (nextKey == '**' or nextKey == '[['):
-                #nextKey is **, find the descendant parents matching the first
-                index = index + 1
-                if index == len(keys):
-                    #if we exhaust the matching pattern, put all leaf into nodes
-                    leaves = self._findLeaves(curr)
-                    for leaf, leafKey in leaves:
-                        leafKey = fullKey + self.sep + leafKey
-                        groupKey = self._extractGroupKey(pattern, leafKey)
-                        if not nodes.has_key(groupKey):
-                            nodes[groupKey] = []
-                        nodes[groupKey].append((leafKey, leaf))
-                    continue
-                nextKey = keys[index]
-                for next, key in self._dfsKey(nextKey, curr):
-                    queue.append(
-                        (next, fullKey +self.sep + key, index + 1))
-            else:
-                #regular key, directly find the next node
-                try:
-                    next = self._dive(nextKey, curr, create=False)
-                    fullKey = fullKey + self.sep + nextKey
-                    index = index + 1
-                    queue.append((next, fullKey, index))
-                except KeyError:
-                    #key not found, this path is dead
-                    pass
-        return nodes
+        return self.compile(pattern).match(self.root, self._index)
 
     def prefix(self, prefix):
         """ Prefix the tree. """
         prefix = self.normalizeKey(prefix)
-        children = []
-        for child in self.root.children:
-            children.append(child)
-        self.root.children = []
+        root = self._writableRoot()
+        children = root.children
+        root.children = []
         leaf = self.add(prefix, None)
         for child in children:
-            leaf.children.append(child)
+            leaf.addChild(child)
+        #every path changed, so rebuild
+        if self._index != None:
+            self.buildIndex()
+        if self._aggregates != None:
+            self.buildAggregates()
         return self
 
-    def include(self, ptree):
+    def include(self, ptree, conflict='first'):
         """ Include another ptree. 
 
-        Common absolute keys will be merged onto the same path.
+        Common absolute keys will be merged onto the same path. If both
+        trees have a value under the same key, conflict decides which one
+        is kept:
+            first   --  keep the value of this tree
+            last    --  take the value of the other tree
+            error   --  raise KeyError
+            or a function f(key, thisVal, otherVal) returning the value.
+
+        Subtrees only in ptree are shared, not copied. Both trees copy them
+        before changing them later on.
 
         """
+        if not callable(conflict) and not conflict in self.CONFLICT_POLICIES:
+            raise ValueError('Unknown conflict policy: %s' %conflict)
         queue = []
-        queue.append((self.root, ptree.root))
+        queue.append((self._writableRoot(), ptree.root, ()))
         while (len(queue) > 0):
-            this, other = queue.pop()
-            for otherChild in other.children:
-                common = False
-                for thisChild in this.children:
-                    if thisChild.key == otherChild.key:
-                        queue.append((thisChild, otherChild))
-                        common = True
-                        break
-                if not common:
-                    this.children.append(otherChild)
+            this, other, path = queue.pop()
+            for otherChild in other.iterChildren():
+                childPath = path + (otherChild.key,)
+                thisChild = this.getChild(otherChild.key)
+                if thisChild != None:
+                    if thisChild._owner is not self._token:
+                        thisChild = self._copyChild(
+                            this, thisChild, childPath)
+                    if otherChild.val != None:
+                        old = thisChild.val
+                        val = self._resolveConflict(
+                            conflict, childPath, old, otherChild.val)
+                        #an unchanged value would only mark min/max stale
+                        unchanged = val is old or (
+                            isNumeric(val) and isNumeric(old) and val == old)
+                        if self._aggregates != None and not unchanged:
+                            self._updateAggregates(childPath, old, val)
+                        thisChild.val = val
+                    queue.append((thisChild, otherChild, childPath))
+                else:
+                    if not isinstance(otherChild, TreeNode):
+                        otherChild = self._materialize(otherChild)
+                    this.addChild(otherChild)
+                    if self._index != None:
+                        self._indexSubtree(otherChild, childPath)
+                    if self._aggregates != None:
+                        agg = self._aggregateSubtree(otherChild, childPath)
+                        if agg != None:
+                            self._mergeAggregates(childPath, agg)
+        ptree._releaseNodes()
+
+    def _resolveConflict(self, conflict, path, thisVal, otherVal):
+        if thisVal == None or conflict == 'last':
+            return otherVal
+        if conflict == 'first':
+            return thisVal
+        key = self.sep.join(path)
+        if conflict == 'error':
+            raise KeyError('Conflicting values for key %s: %s, %s'
+                           %(key, thisVal, otherVal))
+        return conflict(key, thisVal, otherVal)
 
     def getv(self, key, keepKeys=False):
-        if not ('*' in key or '[' in key):
+        if isinstance(key, TreePattern):
+            pattern = key
+        elif not ('*' in key or '[' in key):
             try:
                 node = self.find(key)
                 return node.val
             except KeyError:
                 return None
         else:
-            keyvals = {}
-            for groupkey, nodes in self.match(key).iteritems():
+            pattern = self.compile(key)
+        keyvals = {}
+        for groupkey, nodes in self.match(pattern).iteritems():
+            if keepKeys:
+                vals = {}
+            else:
+                vals = []
+            for elem in nodes:
+                fullKey, node = elem
                 if keepKeys:
-                    vals = {}
+                    vals[fullKey] = node.val
                 else:
-                    vals = []
-                for elem in nodes:
-                    fullKey, node = elem
-                    if keepKeys:
-                        vals[fullKey] = node.val
-                    else:
-                        vals.append(node.val)
-                keyvals[groupkey] = vals
-            return keyvals
+                    vals.append(node.val)
+            keyvals[groupkey] = vals
+        return keyvals
+
+    def getvArray(self, pattern, dtype=None, missing=None):
+        """ Same as getv(pattern), but each group of values is an array.
+
+        See toArray for dtype and missing. Requires NumPy.
+
+        """
+        keyvals = {}
+        for groupkey, nodes in self.match(pattern).iteritems():
+            keyvals[groupkey] = toArray(
+                [node.val for fullKey, node in nodes], dtype, missing)
+        return keyvals
+
+    def matchTable(self, pattern, dtype=None, missing=None, names=None):
+        """ Return the matches of pattern as a table of NumPy columns.
+
+        The table is an OrderedDict with one column per group of the pattern
+        (named by names, or group0, group1, ...), then the full keys in
+        "key" and the values in "val". Rows are ordered by group key. See
+        toArray for dtype and missing.
+
+        """
+        pattern = self.compile(pattern)
+        matched = self.match(pattern)
+        groups = []
+        keys = []
+        vals = []
+        for groupkey in sorted(matched.iterkeys()):
+            for fullKey, node in matched[groupkey]:
+                groups.append(groupkey)
+                keys.append(fullKey)
+                vals.append(node.val)
+        table = OrderedDict()
+        if pattern.grouped:
+            if names == None:
+                names = ['group%d' %i for i in range(pattern.numGroups)]
+            for i, name in enumerate(names):
+                table[name] = toArray([groupkey[i] for groupkey in groups])
+        table['key'] = toArray(keys)
+        table['val'] = toArray(vals, dtype, missing)
+        return table
 
     def setv(self, key, val):
         self.add(key, val, True)
 
+    def iterRecords(self, sort=True):
+        """ Yield (full key, value) of leaves and valued inner nodes.
+
+        Records are yielded sorted by key path, as PTreeFileWriter expects.
+        If sort is False, they are yielded in tree order.
+
+        """
+        stack = [(self.root, None)]
+        while len(stack) != 0:
+            curr, fullKey = stack.pop()
+            if fullKey != None and (curr.val != None or not curr.hasChild()):
+                yield fullKey, curr.val
+            if sort:
+                children = sorted(curr.iterChildren(),
+                                  key=lambda child: child.key, reverse=True)
+            else:
+                children = reversed(curr.children)
+            for child in children:
+                if fullKey == None:
+                    stack.append((child, child.key))
+                else:
+                    stack.append((child, fullKey + self.sep + child.key))
+
     @staticmethod
     def dump(tree, f):
-        fd = open(f, 'w')
-        pickle.dump(tree, fd)
+        """ Dump the tree to file f in the ptree file format.
+
+        Records are stored sorted by key path, so the insertion order of
+        the children is not kept: a loaded tree has its children in
+        lexicographic order of their keys, e.g. mapper.10 before mapper.2,
+        and so do the value lists getv returns from it. Sort the values by
+        key (getv with keepKeys) where the order matters.
+
+        """
+        writer = PTreeFileWriter(f, tree.sep)
+        for key, val in tree.iterRecords():
+            writer.write(key, val)
+        writer.close()
 
     @staticmethod
     def load(f):
-        fd = open(f, 'r')
-        tree = pickle.load(fd)
+        """ Load a tree dumped by dump(), or a pickled tree.
+
+        Children of a tree loaded from a ptree file are in lexicographic
+        order of their keys, not in the order they were added, see dump().
+        Pickled trees keep the insertion order.
+
+        """
+        if not PTreeFileReader.isPTreeFile(f):
+            fd = open(f, 'rb')
+            tree = pickle.load(fd)
+            fd.close()
+            return tree
+        reader = PTreeFileReader(f)
+        tree = reader.toTree()
+        reader.close()
         return tree
 
     @staticmethod
-    def merge(ptrees, sep='.'):
+    def open(f):
+        """ Open a dump lazily. Return a PTreeFileReader. """
+        return PTreeFileReader(f)
+
+    @staticmethod
+    def merge(ptrees, sep='.', conflict='first', numProcs=1):
+        """ Merge trees into a new tree.
+
+        ptrees can be trees or dump file names. Conflicts are resolved in
+        the order of ptrees as in include().
+
+        numProcs is accepted for compatibility and ignored. Merging is
+        bound by building the nodes of the result, which only the calling
+        process can do, so worker processes made the merge slower, not
+        faster.
+
+        """
         newtree = PropertyTree(sep)
         for ptree in ptrees:
-            newtree.include(ptree)
+            if isinstance(ptree, basestring):
+                ptree = PropertyTree.load(ptree)
+            newtree.include(ptree, conflict)
+        return newtree
+
+    @staticmethod
+    def fromLogs(paths, patterns, keyFunc=None, sep='.', conflict='last',
+                 numProcs=1, chunkSize=None, filterstring=None):
+        """ Parse log files with KeyValParser patterns into a new tree.
+
+        paths are files or directories, whose files matching filterstring
+        are parsed. Files larger than chunkSize are split into chunks on
+        line boundaries. The chunks are parsed with a MultiKeyValParser of
+        the patterns over a pool of numProcs processes, each into a partial
+        tree, and the partial trees are included in order as they come in.
+
+        Each parsed (key, val) is added under keyFunc(filename, key), or
+        under key if keyFunc is None. Drop it if keyFunc returns None.
+        Conflicts are resolved in file and line order as in include(). The
+        default 'last' keeps the last value of a repeated key, as adding
+        the parsed pairs one by one does.
+        With numProcs > 1, keyFunc and conflict must be module level
+        functions or policy names.
+
+        """
+        if chunkSize == None:
+            chunkSize = PropertyTree.LOG_CHUNK_SIZE
+        if isinstance(paths, basestring):
+            paths = [paths]
+        tasks = []
+        for path in paths:
+            if os.path.isdir(path):
+                files = sorted(fu.iterFiles(path, filterstring=filterstring))
+            else:
+                files = [(path, os.path.getsize(path))]
+            for filename, size in files:
+                for start in range(0, max(size, 1), chunkSize):
+                    tasks.append((filename, start, start + chunkSize,
+                                  patterns, keyFunc, sep, conflict))
+        newtree = PropertyTree(sep)
+        if numProcs <= 1 or len(tasks) <= 1:
+            for task in tasks:
+                newtree.include(_parseLogTask(task), conflict)
+            return newtree
+        pool = multiprocessing.Pool(numProcs)
+        try:
+            for ptree in pool.imap(_parseLogTask, tasks):
+                newtree.include(ptree, conflict)
+        finally:
+            pool.close()
+            pool.join()
         return newtree
 
+    def iteritems(self, prefix=None, leavesOnly=True):
+        """ Yield (full key, value) of the leaves in tree order.
+
+        If leavesOnly is False, yield every node. If prefix is given, only
+        yield the subtree at prefix, including the prefix node itself. Full
+        keys are only joined for the yielded nodes.
+
+        """
+        sep = self.sep
+        levels = []
+        node = self.root
+        if prefix != None and prefix != '':
+            prefix = self.normalizeKey(prefix)
+            try:
+                node = self._dive(prefix, self.root)
+            except KeyError:
+                return
+            levels.append(prefix)
+            if not leavesOnly or not node.hasChild():
+                yield prefix, node.val
+        stack = [node.iterChildren()]
+        while len(stack) != 0:
+            for child in stack[-1]:
+                levels.append(child.key)
+                if child.hasChild():
+                    if not leavesOnly:
+                        yield sep.join(levels), child.val
+                    stack.append(child.iterChildren())
+                    break
+                yield sep.join(levels), child.val
+                levels.pop()
+            else:
+                stack.pop()
+                if len(stack) != 0:
+                    levels.pop()
+
+    def writeTo(self, fh):
+        """ Write "key: value" lines of the leaves to a file object. """
+        for key, val in self.iteritems():
+            fh.write('%s: %s\n' %(key, val))
+
     def __str__(self):
         """Retrun all the keys and values."""
-        queue=[]
-        queue.append((self.root, self.root.key))
+        return '\n'.join('%s: %s' %(key, val) for key, val in self.iteritems())
+
+def _inferDtype(vals):
+    types = set(type(val) for val in vals if val is not None)
+    if len(types) == 0:
+        return numpy.float64
+    if types <= set([bool]):
+        return numpy.bool_
+    if types <= set([bool, int, long]):
+        return numpy.int64
+    if types <= set([bool, int, long, float]):
+        return numpy.float64
+    if types <= set([str]) or types <= set([unicode]):
+        #let numpy pick the string width
+        return None
+    return object
+
+def toArray(vals, dtype=None, missing=None):
+    """ Convert a list of values into a NumPy array.
+
+    If dtype is None, it is inferred: bool, int64 or float64 for numbers,
+    a string dtype for strings and object for anything else. None values
+    are replaced by missing. If missing is None, integer and bool arrays
+    holding None become float64 and None becomes NaN.
+
+    """
+    if numpy == None:
+        raise ImportError('NumPy is required to build arrays')
+    hasMissing = any(val is None for val in vals)
+    if dtype == None:
+        dtype = _inferDtype(vals)
+    if hasMissing:
+        if missing == None and dtype != None and dtype != object:
+            if numpy.dtype(dtype).kind in 'biu':
+                dtype = numpy.float64
+            if numpy.dtype(dtype).kind in 'fc':
+                missing = numpy.nan
+        vals = [missing if val is None else val for val in vals]
+    if dtype == object:
+        #avoid numpy turning nested sequences into more dimensions
+        array = numpy.empty(len(vals), dtype=object)
+        for i in range(len(vals)):
+            array[i] = vals[i]
+        return array
+    return numpy.array(vals, dtype=dtype)
+
+def _parseLogTask(args):
+    """ Pool task of PropertyTree.fromLogs.
+
+    Parse the lines starting in the byte range [start, end) of the file.
+
+    """
+    filename, start, end, patterns, keyFunc, sep, conflict = args
+    f = open(filename, 'rb')
+    try:
+        if start > 0:
+            f.seek(start - 1)
+            if f.read(1) != '\n':
+                #the line belongs to the previous chunk
+                f.readline()
+        data = f.read(max(end - f.tell(), 0))
+        if len(data) != 0 and not data.endswith('\n'):
+            data += f.readline()
+    finally:
+        f.close()
+    ptree = PropertyTree(sep)
+    items = OrderedDict()
+    parser = MultiKeyValParser(patterns)
+    for key, val in parser.parseStream(cStringIO.StringIO(data)):
+        if keyFunc != None:
+            key = keyFunc(filename, key)
+            if key == None:
+                continue
+        key = ptree.normalizeKey(str(key))
+        if items.has_key(key):
+            val = ptree._resolveConflict(
+                conflict, tuple(key.split(sep)), items[key], val)
+        items[key] = val
+    return ptree.addItems(items.iteritems())
+
+def encodeValue(val):
+    """ Encode a value into a one line, type tagged string.
+
+    Tags: n None, T/F bool, i int, f float, s str, u unicode, r other python
+    literals (lists, tuples, dicts of literals), p pickle for anything else.
+
+    """
+    if val is None:
+        return 'n'
+    if val is True:
+        return 'T'
+    if val is False:
+        return 'F'
+    valType = type(val)
+    if valType is int or valType is long:
+        return 'i' + str(val)
+    if valType is float:
+        return 'f' + repr(val)
+    if valType is str:
+        return 's' + val.encode('string_escape')
+    if valType is unicode:
+        return 'u' + val.encode('utf-8').encode('string_escape')
+    try:
+        literal = repr(val)
+        if ast.literal_eval(literal) == val:
+            return 'r' + literal.encode('string_escape')
+    except (ValueError, SyntaxError):
+        pass
+    return 'p' + pickle.dumps(val).encode('string_escape')
+
+def decodeValue(string):
+    tag = string[0]
+    if tag == 'n':
+        return None
+    if tag == 'T':
+        return True
+    if tag == 'F':
+        return False
+    if tag == 'i':
+        return int(string[1:])
+    if tag == 'f':
+        return float(string[1:])
+    if tag == 's':
+        return string[1:].decode('string_escape')
+    if tag == 'u':
+        return string[1:].decode('string_escape').decode('utf-8')
+    if tag == 'r':
+        return ast.literal_eval(string[1:].decode('string_escape'))
+    if tag == 'p':
+        return pickle.loads(string[1:].decode('string_escape'))
+    raise ValueError('Unknown value tag: %s' %tag)
+
+def _iterRecordNodes(records, path):
+    """ Yield (node path, item, isRecord, isLeaf) for the nodes under path.
+
+    records yields (record path, item) sorted by path, from the first record
+    not less than path on. Inner nodes without a record of their own are
+    implied by the records below them and yielded with isRecord False and
+    the item of the first of those records.
+
+    """
+    depth = len(path)
+    prevPath = None
+    prevItem = None
+    for recordPath, item in records:
+        if recordPath[:depth] != path:
+            break
+        #the inner nodes not shared with the previous record are new
+        common = depth - 1
+        if prevPath != None:
+            isLeaf = recordPath[:len(prevPath)] != prevPath
+            yield prevPath, prevItem, True, isLeaf
+            common = depth
+            while common < min(len(prevPath), len(recordPath)) and \
+                  prevPath[common] == recordPath[common]:
+                common += 1
+        for d in range(max(common + 1, 1), len(recordPath)):
+            yield recordPath[:d], item, False, False
+        prevPath = recordPath
+        prevItem = item
+    if prevPath != None:
+        yield prevPath, prevItem, True, True
+
+def _matchRecordNodes(pattern, nodes, sep, getItem):
+    """ Match the pattern against nodes from _iterRecordNodes.
+
+    Return a dict of group key -> [(full key, getItem(path, item, isRecord)),
+    ...] with the same matches as TreePattern.match on the tree.
+
+    """
+    steps = pattern.steps
+    #a trailing ** or [[ only matches leaves
+    leavesOnly = len(steps) != 0 and steps[-1][0] == TreePattern.DEEP \
+            and steps[-1][1] == None
+    ret = {}
+    for path, item, isRecord, isLeaf in nodes:
+        if leavesOnly and not isLeaf:
+            continue
+        fullKey = sep.join(path)
+        groupKey = pattern.matchKey(fullKey)
+        if groupKey == None:
+            continue
+        if not ret.has_key(groupKey):
+            ret[groupKey] = []
+        ret[groupKey].append((fullKey, getItem(path, item, isRecord)))
+    return ret
+
+
+class PTreeFileWriter(object):
+    """ Incrementally write a PropertyTree dump file.
+
+    The file is a flat list of "<full key>\\t<encoded value>" records, one per
+    leaf (and per inner node holding a value), sorted by key path so that
+    every subtree is contiguous. Records are grouped into blocks of about
+    BLOCK_SIZE bytes. The first key and offset of every block are written as
+    an index after the records and the index offset in a fixed size trailer,
+    so that readers can seek to a key without reading the whole file.
+
+    Records must be written in sorted order.
+
+    """
+    MAGIC = '#ptree'
+    VERSION = 1
+    BLOCK_SIZE = 64 * 1024
+    TRAILER = '#index %016d\n'
+    TRAILER_SIZE = len(TRAILER %0)
+
+    def __init__(self, filename, sep='.'):
+        self.sep = sep
+        self.fd = open(filename, 'wb')
+        self.fd.write('%s %s %s\n' %(self.MAGIC, self.VERSION,
+                                     sep.encode('string_escape')))
+        self.blocks = []
+        self.blockBytes = self.BLOCK_SIZE
+        self.lastPath = None
+        self.numRecords = 0
+
+    def write(self, key, val):
+        path = tuple(key.split(self.sep))
+        if self.lastPath != None and path <= self.lastPath:
+            raise ValueError('Records not sorted or duplicated: %s after %s'
+                             %(key, self.sep.join(self.lastPath)))
+        record = '%s\t%s\n' %(key, encodeValue(val))
+        if self.blockBytes >= self.BLOCK_SIZE:
+            self.blocks.append((self.fd.tell(), key))
+            self.blockBytes = 0
+        self.fd.write(record)
+        self.blockBytes += len(record)
+        self.lastPath = path
+        self.numRecords += 1
+
+    def close(self):
+        indexOffset = self.fd.tell()
+        for offset, key in self.blocks:
+            self.fd.write('%d\t%s\n' %(offset, key))
+        self.fd.write(self.TRAILER %indexOffset)
+        self.fd.close()
+
+
+class PTreeFileReader(object):
+    """ Lazily read a PropertyTree dump file.
+
+    Only the header and the block index are read on open. Records are
+    streamed from disk on iteration and queries, and lookups under a key
+    prefix only read the blocks that may contain it.
+
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = open(filename, 'rb')
+        header = self.fd.readline().rstrip('\n').split(' ')
+        if len(header) != 3 or header[0] != PTreeFileWriter.MAGIC:
+            raise ValueError('Not a ptree dump file: %s' %filename)
+        if int(header[1]) != PTreeFileWriter.VERSION:
+            raise ValueError('Unsupported ptree dump version: %s' %header[1])
+        self.sep = header[2].decode('string_escape')
+        self.dataOffset = self.fd.tell()
+        self.fd.seek(-PTreeFileWriter.TRAILER_SIZE, os.SEEK_END)
+        trailer = self.fd.read()
+        if not trailer.startswith('#index '):
+            raise ValueError('Truncated ptree dump file: %s' %filename)
+        self.indexOffset = int(trailer[7:])
+        self.fd.seek(self.indexOffset)
+        self.blockOffsets = []
+        self.blockPaths = []
+        while True:
+            line = self.fd.readline()
+            if line.startswith('#index '):
+                break
+            offset, key = line.rstrip('\n').split('\t', 1)
+            self.blockOffsets.append(int(offset))
+            self.blockPaths.append(tuple(key.split(self.sep)))
+
+    @staticmethod
+    def isPTreeFile(filename):
+        fd = open(filename, 'rb')
+        magic = fd.read(len(PTreeFileWriter.MAGIC))
+        fd.close()
+        return magic == PTreeFileWriter.MAGIC
+
+    def close(self):
+        self.fd.close()
+
+    def _iterRecords(self, offset):
+        self.fd.seek(offset)
+        end = self.indexOffset
+        while self.fd.tell() < end:
+            line = self.fd.readline()
+            key, val = line.rstrip('\n').split('\t', 1)
+            yield key, val
+
+    def _iterPaths(self, path):
+        """ Yield (record path, (key, encoded value)) from the first record
+        not less than path on.
+        """
+        if len(path) == 0:
+            offset = self.dataOffset
+        else:
+            block = bisect.bisect_right(self.blockPaths, path) - 1
+            if block < 0:
+                offset = self.dataOffset
+            else:
+                offset = self.blockOffsets[block]
+        for key, val in self._iterRecords(offset):
+            recordPath = tuple(key.split(self.sep))
+            if recordPath >= path:
+                yield recordPath, (key, val)
+
+    def iteritems(self, prefix=None):
+        """ Yield (full key, value) of all records, or the ones under prefix.
+        """
+        path = ()
+        if prefix != None and prefix != '':
+            path = tuple(prefix.strip(self.sep).split(self.sep))
+        depth = len(path)
+        for recordPath, (key, val) in self._iterPaths(path):
+            if recordPath[:depth] != path:
+                break
+            yield key, decodeValue(val)
+
+    def match(self, pattern):
+        """ Stream the records matching the wildcard pattern.
+
+        Return a dict of group key -> [(full key, value), ...] with the same
+        matches as PropertyTree.match on the loaded tree. Inner nodes without
+        a record match with the value None.
+
+        """
+        if not isinstance(pattern, TreePattern):
+            pattern = TreePattern(pattern, self.sep)
+        path = ()
+        if len(pattern.steps) != 0 and \
+           pattern.steps[0][0] == TreePattern.LITERAL:
+            path = pattern.steps[0][1]
+
+        def getValue(path, record, isRecord):
+            if isRecord:
+                return decodeValue(record[1])
+            return None
+
+        nodes = _iterRecordNodes(self._iterPaths(path), path)
+        return _matchRecordNodes(pattern, nodes, self.sep, getValue)
+
+    def getv(self, key, keepKeys=False):
+        """ Same as PropertyTree.getv, but reading from the file. """
+        if not isinstance(key, TreePattern) and \
+           not ('*' in key or '[' in key):
+            for fullKey, val in self.iteritems(key):
+                if fullKey == key.strip(self.sep):
+                    return val
+                break
+            return None
+        keyvals = {}
+        for groupkey, records in self.match(key).iteritems():
+            if keepKeys:
+                keyvals[groupkey] = dict(records)
+            else:
+                keyvals[groupkey] = [val for fullKey, val in records]
+        return keyvals
+
+    def toTree(self):
+        """ Materialize the whole file as a PropertyTree. """
+        return PropertyTree.fromItems(self.iteritems(), sep=self.sep)
+
+    def __iter__(self):
+        return self.iteritems()
+
+class MappedTreeNode(object):
+    """ A read-only TreeNode view into a MappedPropertyTree.
+
+    The node only holds its path and the offset of the first record of its
+    subtree. Its value and children are read from the mapped file on access.
+
+    """
+    __slots__ = ('_tree', '_path', '_offset')
+
+    def __init__(self, tree, path, offset):
+        self._tree = tree
+        self._path = path
+        self._offset = offset
+
+    @property
+    def key(self):
+        if len(self._path) == 0:
+            return ''
+        return self._path[-1]
+
+    @property
+    def val(self):
+        if self._offset >= self._tree.indexOffset:
+            return None
+        key, nextOffset = self._tree._readKey(self._offset)
+        if tuple(key.split(self._tree.sep)) != self._path:
+            return None
+        return self._tree._readValue(self._offset)
+
+    @property
+    def children(self):
+        return tuple(self.iterChildren())
+
+    def iterChildren(self):
+        depth = len(self._path)
+        childKey = None
+        for offset, path in self._tree._iterPaths(self._offset):
+            if path[:depth] != self._path:
+                break
+            if len(path) == depth or path[depth] == childKey:
+                continue
+            childKey = path[depth]
+            yield MappedTreeNode(self._tree, path[:depth + 1], offset)
+
+    def numChildren(self):
+        return len(self.children)
+
+    def getChild(self, key, default=None):
+        child = self._tree._node(self._path + (key,))
+        if child == None:
+            return default
+        return child
+
+    def hasChild(self):
+        for child in self.iterChildren():
+            return True
+        return False
+
+    def __str__(self):
         ret = []
-        while len(queue) != 0:
-            curr, fullKey = queue.pop()
-            if not curr.hasChild():
-                ret.append(fullKey.strip(self.sep) + ": " + str(curr.val))
+        ret.append(self.key + "->[")
+        for child in self.iterChildren():
+            ret.append(child.key + ", ")
+        ret.append("]")
+        return ''.join(ret)
+
+
+class MappedPropertyTree(PropertyTree):
+    """ A read-only PropertyTree backed by a mmap of a ptree dump file.
+
+    find, getv and match read the records straight from the mapped file
+    without building the tree, so many processes opening the same dump share
+    one copy in the page cache. Wildcard queries with a leading literal key
+    only scan the records under that key. Modifying the tree raises
+    TypeError.
+
+    """
+    def __init__(self, filename):
+        reader = PTreeFileReader(filename)
+        reader.close()
+        PropertyTree.__init__(self, reader.sep)
+        self.filename = filename
+        self.dataOffset = reader.dataOffset
+        self.indexOffset = reader.indexOffset
+        self.blockOffsets = reader.blockOffsets
+        self.blockPaths = reader.blockPaths
+        fd = open(filename, 'rb')
+        self.mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        fd.close()
+        self.root = MappedTreeNode(self, (), self.dataOffset)
+
+    def close(self):
+        self.mm.close()
+
+    def _readKey(self, offset):
+        """ Return the key of the record at offset and the next offset. """
+        tab = self.mm.find('\t', offset)
+        return self.mm[offset:tab], self.mm.find('\n', tab) + 1
+
+    def _readValue(self, offset):
+        tab = self.mm.find('\t', offset)
+        return decodeValue(self.mm[tab + 1:self.mm.find('\n', tab)])
+
+    def _iterPaths(self, offset):
+        """ Yield (offset, path) of the records from offset on. """
+        sep = self.sep
+        while offset < self.indexOffset:
+            key, nextOffset = self._readKey(offset)
+            yield offset, tuple(key.split(sep))
+            offset = nextOffset
+
+    def _seek(self, path):
+        """ Return the offset of the first record not less than path. """
+        block = bisect.bisect_right(self.blockPaths, path) - 1
+        if block < 0:
+            return self.dataOffset
+        for offset, recordPath in self._iterPaths(self.blockOffsets[block]):
+            if recordPath >= path:
+                return offset
+        return self.indexOffset
+
+    def _node(self, path):
+        """ Return the node at path or None if not existed. """
+        offset = self._seek(path)
+        if offset >= self.indexOffset:
+            return None
+        key, nextOffset = self._readKey(offset)
+        if tuple(key.split(self.sep))[:len(path)] != path:
+            return None
+        return MappedTreeNode(self, path, offset)
+
+    def _iterNodes(self, path):
+        """ Yield (path, offset, isRecord, isLeaf) for the nodes under path.
+
+        Inner nodes without a record get the offset of the first record in
+        their subtree.
+
+        """
+        records = ((recordPath, offset) for offset, recordPath
+                   in self._iterPaths(self._seek(path)))
+        return _iterRecordNodes(records, path)
+
+    def find(self, key):
+        key = self.normalizeKey(key)
+        if key == '':
+            return self.root
+        node = self._node(tuple(key.split(self.sep)))
+        if node == None:
+            raise KeyError("Key not found: %s" %key)
+        return node
+
+    def match(self, pattern):
+        pattern = self.compile(pattern)
+        steps = pattern.steps
+        prefix = ()
+        if len(steps) != 0 and steps[0][0] == TreePattern.LITERAL:
+            prefix = steps[0][1]
+
+        def getNode(path, offset, isRecord):
+            return MappedTreeNode(self, path, offset)
+
+        return _matchRecordNodes(pattern, self._iterNodes(prefix), self.sep,
+                                 getNode)
+
+    def iterRecords(self, sort=True):
+        #records are stored sorted, which is also the tree order
+        offset = self.dataOffset
+        while offset < self.indexOffset:
+            key, nextOffset = self._readKey(offset)
+            yield key, self._readValue(offset)
+            offset = nextOffset
+
+    def iteritems(self, prefix=None, leavesOnly=True):
+        """ Same as PropertyTree.iteritems, in key path order. """
+        path = ()
+        if prefix != None and prefix != '':
+            path = tuple(self.normalizeKey(prefix).split(self.sep))
+        for nodePath, offset, isRecord, isLeaf in self._iterNodes(path):
+            if leavesOnly and not isLeaf:
                 continue
-            for child in curr.children:
-                queue.append((child, fullKey + self.sep + child.key))
-        return '\n'.join(ret)
+            node = MappedTreeNode(self, nodePath, offset)
+            yield self.sep.join(nodePath), node.val
+
+    def _readOnly(self, *args, **kwargs):
+        raise TypeError('MappedPropertyTree is read-only')
+
+    add = addItems = remove = prefix = include = _readOnly
+    buildIndex = buildAggregates = snapshot = _readOnly
+
+    def __getstate__(self):
+        raise TypeError('MappedPropertyTree cannot be pickled')
+
+def _exclusive(method):
+    """ Wrap a PropertyTree method to run holding all locks of the tree. """
+    def wrapper(self, *args, **kwargs):
+        with self._lockAll():
+            return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+class ConcurrentPropertyTree(PropertyTree):
+    """ A PropertyTree that can be modified by many threads.
+
+    Each top level key is guarded by one of NUM_STRIPES locks, so threads
+    adding, removing or finding keys under different top level keys rarely
+    wait for each other. The root has its own lock, only taken to add or
+    copy a top level node. Only the top level key is striped: threads
+    writing under the same top level key, e.g. plan0.mapper.1 and
+    plan0.reducer.2, are serialized. Spread concurrent writers over top
+    level keys to let them run in parallel.
+
+    Changing a top level key and the operations spanning the whole tree
+    (prefix, include, index and aggregates) take all locks. So do adds and
+    removes while the tree is indexed or aggregated, since those structures
+    are shared by all subtrees.
+
+    match, getv and iteritems of a prefix run under the stripe lock of the
+    first key if it is literal, otherwise under all locks. Walks of the
+    whole tree (iteritems without prefix, iterRecords and dumps) go through
+    snapshot(), which returns a consistent, read-only PropertyTree in O(1).
+    A snapshot gives up the ownership of all nodes, so the next write to
+    each node copies it: take snapshots for whole tree walks, whose cost is
+    of the same order, not for small reads.
+
+    """
+    NUM_STRIPES = 64
+
+    def __init__(self, sep=".", indexed=False, aggregated=False):
+        self._initLocks()
+        PropertyTree.__init__(self, sep, indexed, aggregated)
+
+    def _initLocks(self):
+        self._stripes = [threading.Lock() for i in range(self.NUM_STRIPES)]
+        self._rootLock = threading.Lock()
+        self._exclusiveOwner = None
+
+    def __getstate__(self):
+        state = PropertyTree.__getstate__(self)
+        del state['_stripes']
+        del state['_rootLock']
+        del state['_exclusiveOwner']
+        return state
+
+    def __setstate__(self, state):
+        self._initLocks()
+        PropertyTree.__setstate__(self, state)
+
+    @contextlib.contextmanager
+    def _lockAll(self):
+        """ Hold all locks. The current thread may already hold them. """
+        me = thread.get_ident()
+        if self._exclusiveOwner == me:
+            yield
+            return
+        for lock in self._stripes:
+            lock.acquire()
+        self._rootLock.acquire()
+        self._exclusiveOwner = me
+        try:
+            yield
+        finally:
+            self._exclusiveOwner = None
+            self._rootLock.release()
+            for lock in reversed(self._stripes):
+                lock.release()
+
+    def _stripe(self, levelKey):
+        return self._stripes[hash(levelKey) % self.NUM_STRIPES]
+
+    def _topChild(self, levelKey):
+        """ Return the owned top level node, creating it if missing.
+
+        The caller holds the stripe lock of levelKey, so no other thread
+        changes the node. The root lock is only taken if the root changes.
+
+        """
+        child = self.root.getChild(levelKey)
+        if child == None or child._owner is not self._token:
+            with self._rootLock:
+                root = self._writableRoot()
+                child = root.getChild(levelKey)
+                if child == None:
+                    child = root.addChild(
+                        TreeNode(levelKey, None, owner=self._token))
+                elif child._owner is not self._token:
+                    child = root.addChild(child.copy(self._token))
+        return child
+
+    def snapshot(self):
+        """ Return a read-only PropertyTree snapshot of the tree in O(1). """
+        with self._lockAll():
+            snap = PropertyTree(self.sep)
+            snap.root = self.root
+            snap._frozen = True
+            self._releaseNodes()
+        return snap
+
+    def find(self, key):
+        if self._exclusiveOwner == thread.get_ident():
+            return PropertyTree.find(self, key)
+        key = self.normalizeKey(key)
+        with self._stripe(key.split(self.sep, 1)[0]):
+            return self._dive(key, self.root)
+
+    def add(self, key, val, overwrite=True):
+        if self._exclusiveOwner != thread.get_ident():
+            key = self.normalizeKey(key)
+            parentKey, childKey = self.splitKey(key)
+            if parentKey != '':
+                first = parentKey.split(self.sep, 1)[0]
+                with self._stripe(first):
+                    if self._index == None and self._aggregates == None:
+                        parent = self._dive(parentKey[len(first) + 1:],
+                                            self._topChild(first),
+                                            create=True)
+                        return self._setChild(
+                            parent, key, childKey, val, overwrite)
+        with self._lockAll():
+            return PropertyTree.add(self, key, val, overwrite)
+
+    def remove(self, key):
+        if self._exclusiveOwner != thread.get_ident():
+            key = self.normalizeKey(key)
+            parentKey, childKey = self.splitKey(key)
+            if parentKey != '':
+                first = parentKey.split(self.sep, 1)[0]
+                with self._stripe(first):
+                    if self._index == None and self._aggregates == None:
+                        try:
+                            parent = self._dive(parentKey, self.root)
+                        except KeyError:
+                            return False
+                        if parent.getChild(childKey) == None:
+                            return False
+                        parent = self._dive(parentKey[len(first) + 1:],
+                                            self._topChild(first),
+                                            create=True)
+                        parent.removeChild(childKey)
+                        return True
+        with self._lockAll():
+            return PropertyTree.remove(self, key)
+
+    def include(self, ptree, conflict='first'):
+        if isinstance(ptree, ConcurrentPropertyTree):
+            ptree = ptree.snapshot()
+        with self._lockAll():
+            return PropertyTree.include(self, ptree, conflict)
+    include.__doc__ = PropertyTree.include.__doc__
+
+    @contextlib.contextmanager
+    def _readLock(self, firstKey):
+        """ Hold the locks to read under the top level key firstKey.
+
+        firstKey is None if the read is not limited to one top level key.
+
+        """
+        if self._exclusiveOwner == thread.get_ident():
+            yield
+        elif firstKey == None or self._index != None:
+            with self._lockAll():
+                yield
+        else:
+            with self._stripe(firstKey):
+                yield
+
+    def match(self, pattern):
+        pattern = self.compile(pattern)
+        kind, arg, group = pattern.steps[0]
+        firstKey = None
+        if kind == TreePattern.LITERAL:
+            firstKey = arg[0]
+        with self._readLock(firstKey):
+            return PropertyTree.match(self, pattern)
+
+    def iteritems(self, prefix=None, leavesOnly=True):
+        if prefix == None or prefix == '':
+            return self.snapshot().iteritems(prefix, leavesOnly)
+        prefix = self.normalizeKey(prefix)
+        with self._readLock(prefix.split(self.sep, 1)[0]):
+            items = list(PropertyTree.iteritems(self, prefix, leavesOnly))
+        return iter(items)
+
+    def iterRecords(self, sort=True):
+        return self.snapshot().iterRecords(sort)
+
+    addItems = _exclusive(PropertyTree.addItems)
+    prefix = _exclusive(PropertyTree.prefix)
+    buildIndex = _exclusive(PropertyTree.buildIndex)
+    dropIndex = _exclusive(PropertyTree.dropIndex)
+    buildAggregates = _exclusive(PropertyTree.buildAggregates)
+    dropAggregates = _exclusive(PropertyTree.dropAggregates)
+    aggregate = _exclusive(PropertyTree.aggregate)
+
+
+def convertPickleDump(src, dst):
+    """ Convert a pickled PropertyTree dump into the ptree file format. """
+    fd = open(src, 'rb')
+    tree = pickle.load(fd)
+    fd.close()
+    PropertyTree.dump(tree, dst)
+
 
 def testPropertyTree():
     pt = PropertyTree()
@@ -478,21 +2215,347 @@ def testPropertyTree():
     print pt.getv("*.*.[.mapper.[[")
     print pt.getv("*.*.[.mapper.[.[[")
     print pt.getv("[[.mapper.**")
+    testCopyOnWrite()
+    testAggregates()
+    testIndexedMatch()
+    testMappedReadOnly()
+    testDumpMatch()
+
+def _treeItems(tree):
+    return list(tree.iteritems(leavesOnly=False))
+
+def testCopyOnWrite():
+    #a snapshot does not see later changes
+    pt = PropertyTree()
+    pt.add('a.b', 1)
+    pt.add('a.c.d', 2)
+    pt.add('e', 3)
+    snap = pt.snapshot()
+    before = _treeItems(snap)
+    pt.add('a.b', 10)
+    pt.add('a.c.f', 4)
+    pt.remove('a.c.d')
+    pt.remove('e')
+    assert _treeItems(snap) == before
+    pt.prefix('p')
+    pt.addItems([('p.a.b', 11), ('p.a.c.g', 5), ('q', 6)])
+    assert _treeItems(snap) == before
+    assert pt.getv('p.a.b') == 11 and pt.getv('p.a.c.d') == None
+    try:
+        snap.add('a.b', 0)
+        assert False, 'snapshot is writable'
+    except TypeError:
+        pass
+    #a snapshot of a snapshot-sharing tree stays intact too
+    snap2 = pt.snapshot()
+    before2 = _treeItems(snap2)
+    pt.addItems([('p.a.b', 12)])
+    pt.prefix('r')
+    assert _treeItems(snap2) == before2
+    assert _treeItems(snap) == before
+    #include shares the subtrees but neither tree sees the other's changes
+    src = PropertyTree()
+    src.add('x.y.z', 1)
+    src.add('x.w', 2)
+    src.add('s.t', 3)
+    dst = PropertyTree()
+    dst.add('x.w', 20)
+    dst.add('u', 4)
+    srcBefore = _treeItems(src)
+    dst.include(src, 'last')
+    assert dst.getv('x.w') == 2 and dst.getv('x.y.z') == 1
+    dst.add('x.y.z', 100)
+    dst.add('x.y.v', 101)
+    dst.add('s.t', 102)
+    dst.remove('x.w')
+    assert _treeItems(src) == srcBefore
+    dstBefore = _treeItems(dst)
+    src.add('x.y.z', 200)
+    src.add('s.n', 201)
+    src.remove('s.t')
+    src.prefix('old')
+    assert _treeItems(dst) == dstBefore
+    dst.include(src, 'first')
+    assert dst.getv('x.y.z') == 100 and dst.getv('old.s.n') == 201
+    print 'copy on write: ok'
+
+def testMappedReadOnly():
+    pt = PropertyTree()
+    pt.add('a.b', 1)
+    PropertyTree.dump(pt, '/tmp/testpt.mapped')
+    mapped = MappedPropertyTree('/tmp/testpt.mapped')
+    calls = [
+        ('add', ('a.c', 2)), ('setv', ('a.b', 2)),
+        ('addItems', ([('a.c', 2)],)), ('remove', ('a.b',)),
+        ('prefix', ('p',)), ('include', (pt,)), ('buildIndex', ()),
+        ('buildAggregates', ()), ('snapshot', ()),
+    ]
+    for name, args in calls:
+        try:
+            getattr(mapped, name)(*args)
+            assert False, 'MappedPropertyTree.%s did not raise' %name
+        except TypeError:
+            pass
+    assert list(mapped.iteritems()) == [('a.b', 1)]
+    mapped.close()
+    print 'mapped read only: ok'
+
+def testDumpMatch():
+    """ Queries on a dump file agree with the same queries on the tree. """
+    import random
+    random.seed(3)
+    patterns = ['*', '*.*', '**', '**.x', '[[.x', 'a.*.[', 'x.**.x', 'a.**',
+                'a.[[', '[.*', 'b.[[.x', '**.x.*', 'a', 'a.x', '*.[[',
+                'b.**.0.**', '[[.0.[[', '**.a.**.b', 'a.[[.b.**']
+
+    def normalize(vals):
+        if not isinstance(vals, dict):
+            return vals
+        ret = {}
+        for group, groupVals in vals.iteritems():
+            if isinstance(groupVals, dict):
+                groupVals = groupVals.items()
+            ret[group] = sorted(groupVals)
+        return ret
+
+    trees = [PropertyTree()]
+    trees[0].add('b.0.0', 1)
+    #an empty tree
+    trees.append(PropertyTree())
+    for i in range(100):
+        pt = PropertyTree()
+        for j in range(random.randint(1, 12)):
+            key = '.'.join(random.choice('ab0x')
+                           for k in range(random.randint(1, 4)))
+            pt.add(key, random.choice([None, j, 'v%s' %j]))
+        trees.append(pt)
+    for pt in trees:
+        PropertyTree.dump(pt, '/tmp/testpt.match')
+        reader = PTreeFileReader('/tmp/testpt.match')
+        mapped = MappedPropertyTree('/tmp/testpt.match')
+        for pattern in patterns:
+            for keepKeys in (False, True):
+                expected = normalize(pt.getv(pattern, keepKeys))
+                for other in (reader, mapped):
+                    got = normalize(other.getv(pattern, keepKeys))
+                    assert got == expected, '%s %s: %s != %s' %(
+                        other.__class__.__name__, pattern, got, expected)
+        reader.close()
+        mapped.close()
+    print 'dump match: ok'
+
+def testAggregates():
+    vals = [5, 1, 9, 3, 7]
+    pt = PropertyTree(aggregated=True)
+    for i in range(len(vals)):
+        pt.add('m.%s.t' %i, vals[i])
+    pt.add('m.name', 'not numeric')
+    assert pt.aggregate('m', 'min') == 1 and pt.aggregate('m', 'max') == 9
+    #remove the current min, then the current max
+    pt.remove('m.1')
+    assert pt.aggregate('m', 'min') == 3
+    pt.remove('m.2.t')
+    assert pt.aggregate('m', 'max') == 7
+    assert pt.aggregate('m', 'sum') == 15 and pt.aggregate('m', 'count') == 3
+    assert pt.aggregate('m', 'mean') == 5.0
+    #replacing the min or max by a value inside the range
+    pt.setv('m.3.t', 6)
+    pt.setv('m.4.t', 6)
+    assert pt.aggregate('m', 'min') == 5 and pt.aggregate('m', 'max') == 6
+    #the same queries on a tree without aggregates
+    plain = PropertyTree()
+    for key, val in pt.iteritems():
+        plain.add(key, val)
+    for fn in Aggregate.FUNCTIONS:
+        assert pt.aggregate('m', fn) == plain.aggregate('m', fn)
+        assert pt.aggregate('m.[.t', fn) == plain.aggregate('m.[.t', fn)
+    #pickled aggregates survive the round trip with any protocol
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        copied = pickle.loads(pickle.dumps(pt, protocol))
+        assert copied.aggregated
+        for fn in Aggregate.FUNCTIONS:
+            assert copied.aggregate('m', fn) == pt.aggregate('m', fn)
+        copied.add('m.9.t', 1)
+        assert copied.aggregate('m', 'min') == 1
+    #including the same values does not make min and max stale
+    other = PropertyTree()
+    for key, val in pt.iteritems():
+        other.add(key, val)
+    pt.include(other, 'first')
+    pt.include(other, 'last')
+    assert not pt._aggregates[('m',)].stale
+    pt.remove('m')
+    assert pt.aggregate('m', 'sum') == None
+    print 'aggregates: ok'
+
+def testIndexedMatch():
+    patterns = ['**.time', '[[.time', 'plan0.**.time', 'plan0.[[.mapper.*',
+                '**.mapper.[.time', '*.[[.time', '**', '[.**', '**.mapper',
+                '**.mapper.**', '[[.job.[[']
+    indexed = PropertyTree(indexed=True)
+    plain = PropertyTree()
+    for tree in (indexed, plain):
+        for p in range(2):
+            for m in range(3):
+                tree.add('plan%s.job.mapper.%s.time' %(p, m), p * 10 + m)
+                tree.add('plan%s.job.mapper.%s.host' %(p, m), 'h%s' %m)
+            tree.add('plan%s.time' %p, p)
+        tree.remove('plan1.job.mapper.2')
+        tree.add('plan1.job.mapper', 'inner value')
+        other = PropertyTree()
+        other.add('plan2.mapper.time', 99)
+        tree.include(other)
+
+    def check():
+        for pattern in patterns:
+            for keepKeys in (False, True):
+                a = indexed.getv(pattern, keepKeys)
+                b = plain.getv(pattern, keepKeys)
+                assert a == b, '%s: %s != %s' %(pattern, a, b)
+
+    check()
+    for tree in (indexed, plain):
+        tree.prefix('exp')
+    patterns = ['exp.' + pattern for pattern in patterns] + patterns
+    check()
+    print 'indexed match: ok'
+
+def _deepSizeof(root, slotted):
+    """ Bytes used by the nodes, children indices and keys under root. """
+    size = 0
+    seenKeys = set([])
+    stack = [root]
+    while len(stack) != 0:
+        node = stack.pop()
+        size += sys.getsizeof(node)
+        if not slotted:
+            size += sys.getsizeof(node.__dict__)
+        if node._children is not None:
+            size += sys.getsizeof(node._children)
+            if isinstance(node._children, OrderedDict):
+                #each entry also holds a [prev, next, key] link
+                size += len(node._children) * (
+                    sys.getsizeof([None, None, None]) + 3 * 8)
+                size += sys.getsizeof(node._children._OrderedDict__map)
+            stack.extend(node.children)
+        if id(node.key) not in seenKeys:
+            seenKeys.add(id(node.key))
+            size += sys.getsizeof(node.key)
+    return size
+
+def benchTreeNodeMemory(numMappers=2000):
+    """ Compare memory of the dict based and the slotted node layout. """
+    class DictTreeNode(object):
+        #the layout before slots: instance dict, a children list per node
+        #and one key string per node
+        def __init__(self, key, val):
+            self._key = key
+            self._val = val
+            self._children = []
+
+        @property
+        def key(self):
+            return self._key
+
+        @property
+        def children(self):
+            return self._children
+
+    def keys():
+        for i in range(numMappers):
+            for leaf in ('exec.time', 'read.type', 'read.bytes'):
+                yield 'plan.iter.job.mapper.%s.%s' %(i, leaf), i
+
+    oldRoot = DictTreeNode('', None)
+    for key, val in keys():
+        curr = oldRoot
+        for levelKey in key.split('.'):
+            if len(curr.children) != 0 and curr.children[-1].key == levelKey:
+                curr = curr.children[-1]
+            else:
+                child = DictTreeNode(levelKey, None)
+                curr.children.append(child)
+                curr = child
+        curr._val = val
+    oldSize = _deepSizeof(oldRoot, False)
+
+    pt = PropertyTree()
+    for key, val in keys():
+        pt.add(key, val)
+    newSize = _deepSizeof(pt.root, True)
+
+    print 'TreeNode memory, %s leaves:' %(numMappers * 3)
+    print '  dict layout    : %10d bytes' %oldSize
+    print '  slotted layout : %10d bytes' %newSize
+    print '  ratio          : %10.2f' %(float(newSize) / oldSize)
+
+def benchConcurrentWrites(numKeys=40000, numThreads=(1, 2, 4, 8)):
+    """ Compare write throughput of one global lock and striped locks. """
+    class LockedPropertyTree(PropertyTree):
+        #the whole tree behind one lock
+        def __init__(self):
+            PropertyTree.__init__(self)
+            self.lock = threading.Lock()
+
+        def add(self, key, val, overwrite=True):
+            with self.lock:
+                return PropertyTree.add(self, key, val, overwrite)
+
+    def run(pt, n):
+        #each thread writes under its own top level key
+        def write(worker):
+            for i in xrange(numKeys / n):
+                pt.add('worker%s.job.%s.exec.time' %(worker, i), i)
+        threads = [threading.Thread(target=write, args=(worker,))
+                   for worker in range(n)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return (numKeys / n) * n / (time.time() - start)
+
+    print 'PropertyTree writes, %s keys over disjoint prefixes:' %numKeys
+    print '  threads   global lock  striped locks  (keys/s)'
+    for n in numThreads:
+        print '  %7d  %12d  %13d' %(
+            n, run(LockedPropertyTree(), n), run(ConcurrentPropertyTree(), n))
 
 class PTreeCli(CliRunnable):
     def __init__(self):
         self.availableCommand = {
-            'load' : 'show a property tree dump file',
+            'load' : 'show or query a property tree dump file',
+            'convert' : 'convert a pickled dump to the ptree file format',
             'interact' : 'open a interactive command line',
         }
 
     def load(self, argv):
-        if (len(argv) != 1):
+        if (len(argv) != 1 and len(argv) != 2):
             print
-            print "ptree load <ptree file dump>"
+            print "ptree load <ptree file dump> [pattern]"
             sys.exit(-1)
+        if PTreeFileReader.isPTreeFile(argv[0]):
+            #stream from the file without building the tree
+            ptree = PTreeFileReader(argv[0])
+            if len(argv) == 1:
+                for key, val in ptree.iteritems():
+                    print key + ": " + str(val)
+            else:
+                print ptree.getv(argv[1], True)
+            ptree.close()
+            return
         ptree = PropertyTree.load(argv[0])
-        print ptree
+        if len(argv) == 1:
+            ptree.writeTo(sys.stdout)
+        else:
+            print ptree.getv(argv[1], True)
+
+    def convert(self, argv):
+        if (len(argv) != 2):
+            print
+            print "ptree convert <pickled dump> <ptree file dump>"
+            sys.exit(-1)
+        convertPickleDump(argv[0], argv[1])
 
     def interact(self, argv):
         print 'PropertyTree Interactive Command Line'
@@ -520,7 +2583,7 @@ class PTreeCli(CliRunnable):
                     else:
                         print ptree.getv(args[1].strip(), True)
                 elif args[0] == 'print':
-                    print ptree
+                    ptree.writeTo(sys.stdout)
                 elif args[0] == 'dump':
                     PropertyTree.dump(ptree, args[1].strip())
                 elif args[0] == 'load':
@@ -534,6 +2597,8 @@ class PTreeCli(CliRunnable):
 
 def main():
     testPropertyTree()
+    benchTreeNodeMemory()
+    benchConcurrentWrites()
 
 if __name__ == '__main__':
     main()